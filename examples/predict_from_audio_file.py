@@ -8,9 +8,9 @@ model = Model.load(model_dir)
 cur_seconds = 60
 sample_duration = 2
 
+# The audio is decoded at the sample rate of the model's training data
 with AudioFile('/path/to/some/audio.mp3', start=cur_seconds, duration='10:00',
-               sample_duration=sample_duration) as reader:
-    for sample in reader:
-        prediction = model.predict(sample)
-        print(f'Audio segment at {cur_seconds} seconds: {prediction}')
-        cur_seconds += sample_duration
+               sample_duration=sample_duration, sample_rate=model.decode_rate) as reader:
+    # Segments are scored in batches of 32, with one model forward pass per batch
+    for timestamp, prediction, confidence in model.predict_stream(reader, batch_size=32):
+        print(f'Audio segment at {timestamp} seconds: {prediction} ({confidence:.2f})')
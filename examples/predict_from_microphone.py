@@ -10,9 +10,13 @@ model = Model.load(model_dir)
 audio_system = 'alsa'        # Supported: alsa and pulse
 audio_device = 'plughw:1,0'  # Get list of recognized input devices with arecord -l
 
-with AudioDevice(audio_system, device=audio_device) as source:
-    for sample in source:
-        source.pause()  # Pause recording while we process the frame
-        prediction = model.predict(sample)
+# In buffered mode a background thread keeps reading from the device into a ring buffer
+# while the model processes the previous frames, so no audio is lost during inference.
+# If the model can't keep up, the oldest frames are dropped (overflow='block' would
+# instead stop reading until there is room in the buffer). source.dropped_frames and
+# source.queue_depth report how far behind the consumer is. The audio is decoded at the sample
+# rate of the model's training data.
+with AudioDevice(audio_system, device=audio_device, buffered=True, buffer_size=16,
+                 overflow='drop_oldest', sample_rate=model.decode_rate) as source:
+    for timestamp, prediction, confidence in model.predict_stream(source, batch_size=1):
         print(prediction)
-        source.resume() # Resume recording
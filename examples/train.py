@@ -4,7 +4,7 @@
 import os
 from tensorflow.keras import layers
 
-from micmon.dataset import Dataset
+from micmon.dataset import DatasetCollection
 from micmon.model import Model
 
 # This is a directory that contains the saved .npz dataset files
@@ -13,42 +13,41 @@ datasets_dir = os.path.expanduser('~/datasets/baby-monitor/datasets')
 # This is the output directory where the model will be saved
 model_dir = os.path.expanduser(os.path.join('~', 'models', 'baby-monitor'))
 
-# This is the number of training epochs for each dataset sample
+# This is the number of training epochs over the whole set of datasets
 epochs = 2
 
 # This value establishes the share of the dataset to be used for cross-validation
 validation_split = 0.3
 
-# Load the datasets from the compressed files
-datasets = Dataset.scan(datasets_dir, validation_split=0.3)
+# Index the datasets. The data is read from the files in batches while the model trains,
+# so the datasets don't need to fit in memory.
+datasets = DatasetCollection.scan(datasets_dir)
 
 # Get the number of frequency bins
-freq_bins = len(datasets[0].samples[0])
+freq_bins = datasets.bins
 
 # Create a network with 4 layers (one input layer, two intermediate layers and one output layer).
 # The first intermediate layer in this example will have twice the number of units as the number
 # of input units, while the second intermediate layer will have as many units as the number of
-# input units. We also specify the names for the labels and the low and high frequency range
-# used when sampling.
+# input units. We also specify the names for the labels, the low and high frequency range
+# used when sampling, and the sample rate the audio was decoded at (the model's decode_rate when
+# it's used for predictions).
 model = Model(
     [
         layers.Input(shape=(freq_bins,)),
         layers.Dense(int(2.0 * freq_bins), activation='relu'),
         layers.Dense(int(freq_bins), activation='relu'),
-        layers.Dense(len(datasets[0].labels), activation='softmax'),
+        layers.Dense(len(datasets.labels), activation='softmax'),
     ],
     labels=['negative', 'positive'],
-    low_freq=datasets[0].low_freq,
-    high_freq=datasets[0].high_freq,
+    low_freq=datasets.cutoff_frequencies[0],
+    high_freq=datasets.cutoff_frequencies[1],
+    sample_rate=datasets.sample_rate,
 )
 
-# Train the model
-for epoch in range(epochs):
-    for i, dataset in enumerate(datasets):
-        print(f'[epoch {epoch+1}/{epochs}] [audio sample {i+1}/{len(datasets)}]')
-        model.fit(dataset)
-        evaluation = model.evaluate(dataset)
-        print(f'Validation set loss and accuracy: {evaluation}')
+# Train the model. Samples from all the datasets are interleaved, shuffled and batched, and the
+# last validation_split of each dataset is used to evaluate the model at the end of each epoch.
+model.fit(datasets, epochs=epochs, validation_split=validation_split)
 
 # Save the model
 model.save(model_dir, overwrite=True)
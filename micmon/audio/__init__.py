@@ -4,3 +4,5 @@ from .player import AudioPlayer
 from .source import AudioSource
 from .file import AudioFile
 from .device import AudioDevice
+from .aio import AsyncAudioSource, AsyncAudioFile, AsyncAudioDevice
+from .gate import EnergyGate
@@ -0,0 +1,91 @@
+import asyncio
+from typing import Optional, Tuple
+
+from micmon.audio.segment import AudioSegment
+from micmon.audio.source import AudioSource
+from micmon.audio.file import AudioFile
+from micmon.audio.device import AudioDevice
+from micmon.metrics import metrics
+
+
+class AsyncAudioSource(AudioSource):
+    # asyncio counterpart of AudioSource, to be used through `async with` and `async for`. The ffmpeg
+    # process is run through asyncio.create_subprocess_exec, and its output is read without blocking the
+    # event loop. Once two chunks are waiting in the stream buffer, the transport stops reading from ffmpeg
+    # (which then blocks on its output pipe) until the consumer catches up. The stream buffer replaces the
+    # capture thread and the read pool of the blocking sources, so buffered and pool_size aren't supported.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.buffered or self.pool_size:
+            raise ValueError(f"{self.__class__.__name__} doesn't support buffered or pool_size")
+
+    async def __aenter__(self):
+        self.ffmpeg = await asyncio.create_subprocess_exec(
+            *self.ffmpeg_args, stdout=asyncio.subprocess.PIPE,
+            stderr=None if self.debug else asyncio.subprocess.DEVNULL, limit=self.chunk_size)
+
+        if self._window:
+            self._window.reset()
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self.ffmpeg:
+            return
+
+        if self.ffmpeg.returncode is None:
+            try:
+                self.ffmpeg.terminate()
+            except ProcessLookupError:
+                pass
+
+            try:
+                await asyncio.wait_for(self.ffmpeg.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.logger.warning('FFmpeg process termination timeout')
+                self.ffmpeg.kill()
+                await self.ffmpeg.wait()
+
+        self.ffmpeg = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> AudioSegment:
+        start = metrics.start()
+        while True:
+            item = await self._read_chunk_async()
+            if not item:
+                raise StopAsyncIteration
+
+            segment = self._process_chunk(*item)
+            if segment is not None:
+                if start is not None:
+                    self._observe_read(start, segment)
+                return segment
+
+    async def _read_chunk_async(self) -> Optional[Tuple[float, bytes]]:
+        if not self.ffmpeg:
+            return None
+
+        try:
+            data = await self.ffmpeg.stdout.readexactly(self.chunk_size)
+        except asyncio.IncompleteReadError as e:
+            # End of stream: return the last partial chunk, if any
+            data = e.partial
+
+        return self._timestamp_chunk(data)
+
+    def __enter__(self):
+        raise TypeError(f'{self.__class__.__name__} must be used with async with')
+
+
+class AsyncAudioFile(AudioFile, AsyncAudioSource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.shards > 1:
+            raise ValueError(f"{self.__class__.__name__} doesn't support shards")
+
+
+class AsyncAudioDevice(AudioDevice, AsyncAudioSource):
+    pass
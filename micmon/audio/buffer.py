@@ -0,0 +1,110 @@
+import queue
+import threading
+from collections import deque
+from typing import Any, Optional
+
+import numpy as np
+
+
+class RingBuffer:
+    overflow_policies = ('drop_oldest', 'block')
+
+    def __init__(self, size: int = 16, overflow: str = 'drop_oldest'):
+        assert size > 0, 'The buffer size must be positive'
+        assert overflow in self.overflow_policies, \
+            f'Unsupported overflow policy: {overflow}. Supported: {self.overflow_policies}'
+
+        self.size = size
+        self.overflow = overflow
+        self.dropped = 0
+        self.max_depth = 0
+        self.closed = False
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any):
+        with self._cond:
+            while len(self._items) >= self.size and not self.closed:
+                if self.overflow == 'drop_oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.wait()
+
+            if self.closed:
+                return
+
+            self._items.append(item)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        # Returns None once the buffer is closed and drained, raises queue.Empty on timeout
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed, timeout=timeout):
+                raise queue.Empty
+
+            if not self._items:
+                return None
+
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class SlidingWindow:
+    def __init__(self, window: int, sample_rate: int, channels: int = 1, capacity: int = 32):
+        # window is the number of int16 values per window. The storage has room for `capacity` extra windows
+        # of audio before it needs to be compacted.
+        self.window = window
+        self.samples_per_sec = sample_rate * channels
+        self.capacity = window * (capacity + 1)
+        self.end_time: Optional[float] = None
+        self._data = np.empty(self.capacity, dtype=np.int16)
+        self._end = 0
+
+    @property
+    def start_time(self) -> Optional[float]:
+        if self.end_time is None:
+            return None
+
+        return self.end_time - self.window / self.samples_per_sec
+
+    def reset(self):
+        self.end_time = None
+        self._data = np.empty(self.capacity, dtype=np.int16)
+        self._end = 0
+
+    def push(self, chunk: np.ndarray, timestamp: float) -> Optional[np.ndarray]:
+        # Appends a chunk of audio that starts at `timestamp` and returns a view over the latest window,
+        # or None if there isn't enough audio yet. A gap in the timestamps (e.g. chunks dropped by the
+        # capture buffer) restarts the window.
+        if self.end_time is not None and abs(timestamp - self.end_time) > 0.5 / self.samples_per_sec:
+            self.reset()
+
+        n = len(chunk)
+        if self._end + n > self.capacity:
+            # Compact the tail into a new array rather than in place, so the views returned by earlier
+            # calls keep pointing to valid audio.
+            keep = min(self._end, self.window)
+            data = np.empty(max(self.capacity, keep + n), dtype=np.int16)
+            data[:keep] = self._data[self._end - keep:self._end]
+            self._data = data
+            self._end = keep
+
+        self._data[self._end:self._end + n] = chunk
+        self._end += n
+        self.end_time = timestamp + n / self.samples_per_sec
+        if self._end < self.window:
+            return None
+
+        return self._data[self._end - self.window:self._end]
@@ -1,9 +1,57 @@
 import json
+import math
 import os
 import pathlib
-from typing import Optional, List, Tuple, Union
+import subprocess
+from collections import namedtuple
+from typing import Dict, Optional, List, Sequence, Tuple, Union
+
+import numpy as np
 
 from micmon.audio import AudioSegment, AudioSource, AudioDirectory
+from micmon.audio.shard import DecoderShard
+
+# (N, frame_len) int16 frames, the N label indices (-1 before the first label) and the N start timestamps
+Frames = namedtuple('Frames', ['audio', 'labels', 'timestamps'])
+
+
+class FrameSplitter:
+    # Splits consecutive blocks of int16 audio into (N, frame_len) frames that start every hop_len samples.
+    # The samples that don't complete a frame yet are kept for the next block.
+    def __init__(self, frame_len: int, hop_len: int, samples_per_sec: int):
+        self.frame_len = frame_len
+        self.hop_len = hop_len
+        self.samples_per_sec = samples_per_sec
+        self.tail: Optional[np.ndarray] = None
+        self.time: Optional[float] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self.tail) if self.tail is not None else 0
+
+    def split(self, chunks: Sequence[np.ndarray], timestamp: Optional[float],
+              max_frames: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # timestamp is the time of the first chunk, and it's only used on the first call.
+        # Returns the frames (views over the concatenated audio) and their start timestamps.
+        if self.time is None:
+            self.time = timestamp
+
+        chunks = [self.tail, *chunks] if self.tail is not None else list(chunks)
+        audio = np.concatenate(chunks) if len(chunks) > 1 else (chunks[0] if chunks else np.empty(0, np.int16))
+        n_frames = (len(audio) - self.frame_len) // self.hop_len + 1 if len(audio) >= self.frame_len else 0
+        if max_frames:
+            n_frames = min(n_frames, max_frames)
+
+        frames = np.lib.stride_tricks.sliding_window_view(audio, self.frame_len)[::self.hop_len][:n_frames] \
+            if n_frames else np.empty((0, self.frame_len), dtype=np.int16)
+
+        timestamps = (self.time or 0.) + np.arange(n_frames) * self.hop_len / self.samples_per_sec
+        # The tail is copied because it may point to a buffer of the read pool that is about to be reused
+        self.tail = audio[n_frames * self.hop_len:].copy()
+        if self.time is not None:
+            self.time += n_frames * self.hop_len / self.samples_per_sec
+
+        return frames, timestamps
 
 
 class AudioFile(AudioSource):
@@ -12,13 +60,17 @@ class AudioFile(AudioSource):
                  labels_file: Optional[str] = None,
                  start: Union[str, int, float] = 0,
                  duration: Optional[Union[str, int, float]] = None,
-                 *args, **kwargs):
+                 *args,
+                 shards: int = 1,
+                 ffprobe_bin: str = 'ffprobe',
+                 **kwargs):
         super().__init__(*args, **kwargs)
         if isinstance(audio_file, AudioDirectory):
             labels_file = audio_file.labels_file
             audio_file = audio_file.audio_file
 
         self.audio_file = os.path.abspath(os.path.expanduser(audio_file))
+        self.name = self.name or self.audio_file
 
         if not labels_file:
             labels_file = os.path.join(pathlib.Path(self.audio_file).parent, 'labels.json')
@@ -40,6 +92,24 @@ class AudioFile(AudioSource):
         self.cur_time = self.start
         self.cur_label = None
 
+        # Label lookup tables: the start time in ms of each labelled segment and the index of its label
+        self._label_times = np.array([timestamp for timestamp, _ in self.segments], dtype=np.float64)
+        self._label_codes = np.array([self.labels.index(label) for _, label in self.segments], dtype=np.int64)
+        self._splitter = self._create_splitter(self.sample_duration, hop_duration=self.hop_duration)
+        self._splitters: Dict[float, FrameSplitter] = {}
+
+        # If shards > 1 the file is split into time ranges that are decoded in parallel by separate ffmpeg
+        # processes, and read back in order. Each shard except the last one contains a whole number of
+        # chunks, so the segments, timestamps and labels are the same as with a single decoder, as long as
+        # seeking in the input is sample-accurate (e.g. PCM or lossless formats).
+        if shards > 1 and self.buffered:
+            raise ValueError("shards can't be used together with buffered=True")
+
+        self.shards = shards
+        self.ffprobe_bin = ffprobe_bin
+        self._shards: List[DecoderShard] = []
+        self._shard_index = 0
+
     @classmethod
     def parse_labels_file(cls, labels_file: str) -> List[Tuple[int, Union[int, bool, str]]]:
         with open(labels_file, 'r') as f:
@@ -53,19 +123,162 @@ class AudioFile(AudioSource):
             for timestamp in sorted(segments.keys())
         ]
 
-    def __next__(self) -> AudioSegment:
-        if not self.ffmpeg or self.ffmpeg.poll() is not None:
-            raise StopIteration
+    def label_index(self, timestamps: np.ndarray) -> np.ndarray:
+        # Index of the label of the audio at each timestamp (in seconds), or -1 if it's before the first label
+        i = np.searchsorted(self._label_times, np.asarray(timestamps) * 1000, side='right') - 1
+        if not len(self._label_codes):
+            return np.full(i.shape, -1, dtype=np.int64)
+
+        return np.where(i >= 0, self._label_codes[np.maximum(i, 0)], -1)
+
+    def _create_segment(self, data: Union[bytes, np.ndarray], timestamp: float) -> AudioSegment:
+        i = int(np.searchsorted(self._label_times, timestamp * 1000, side='right')) - 1
+        self.cur_label = self.segments[i][1] if i >= 0 else None
+        return AudioSegment(data, sample_rate=self.sample_rate, channels=self.channels,
+                            label=int(self._label_codes[i]) if i >= 0 else None, timestamp=timestamp)
+
+    def _create_splitter(self, sample_duration: float, hop_duration: Optional[float] = None) -> FrameSplitter:
+        frame_len = int(sample_duration * self.sample_rate) * self.channels
+        hop_len = int(hop_duration * self.sample_rate) * self.channels if hop_duration else frame_len
+        return FrameSplitter(frame_len, hop_len, samples_per_sec=self.sample_rate * self.channels)
+
+    def _read_samples(self, need: Optional[int]) -> Tuple[List[np.ndarray], Optional[float]]:
+        # Reads chunks until at least `need` samples (or the rest of the file) have been read, and returns them
+        # with the timestamp of the first one
+        chunks = []
+        size = 0
+        first_timestamp = None
+
+        while need is None or size < need:
+            item = self._buffer.get() if self._buffer else self._read_chunk()
+            if not item:
+                break
+
+            timestamp, data = item
+            if first_timestamp is None:
+                first_timestamp = timestamp
+
+            chunk = data if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.int16,
+                                                                             count=len(data) // 2)
+            # Chunks read into the pool buffers would be overwritten by the next reads before being concatenated
+            chunks.append(chunk.copy() if self._pool else chunk)
+            size += len(chunk)
+
+        return chunks, first_timestamp
+
+    def read_frames(self, max_frames: Optional[int] = None) -> Frames:
+        # Bulk alternative to iterating over the segments: decodes up to max_frames frames (or the rest of
+        # the file) into one buffer and returns them as a (N, frame_len) view, with labels and timestamps
+        # computed in one pass. With hop_duration the frames overlap and are strided views over the same
+        # buffer. A trailing piece of audio shorter than a frame is dropped. Don't mix it with read().
+        splitter = self._splitter
+        need = splitter.frame_len + (max_frames - 1) * splitter.hop_len - splitter.pending if max_frames else None
+        frames, timestamps = splitter.split(*self._read_samples(need), max_frames=max_frames)
+        return Frames(audio=frames, labels=self.label_index(timestamps), timestamps=timestamps)
+
+    def read_multi_frames(self, sample_durations: Sequence[float],
+                          block_duration: Optional[float] = None) -> Dict[float, Frames]:
+        # Like read_frames, but the same decoded audio is split into non-overlapping frames of each of the
+        # sample_durations. It reads about block_duration seconds of audio (or the rest of the file) and
+        # returns the complete frames for each duration. Don't mix it with read() or read_frames().
+        for sample_duration in sample_durations:
+            if sample_duration not in self._splitters:
+                self._splitters[sample_duration] = self._create_splitter(sample_duration)
+
+        need = int(block_duration * self.sample_rate) * self.channels if block_duration else None
+        chunks, timestamp = self._read_samples(need)
+        frames = {}
+        for sample_duration in sample_durations:
+            audio, timestamps = self._splitters[sample_duration].split(chunks, timestamp)
+            frames[sample_duration] = Frames(audio=audio, labels=self.label_index(timestamps),
+                                             timestamps=timestamps)
+
+        return frames
+
+    def probe_duration(self) -> float:
+        output = subprocess.check_output([
+            self.ffprobe_bin, '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', self.audio_file
+        ])
+
+        return float(output.decode().strip())
+
+    def _shard_args(self, start: float, duration: Optional[float]) -> tuple:
+        # Input seeking (-ss before -i) lets each decoder jump straight to its time range
+        return (
+            self.ffmpeg_bin, '-ss', f'{start:.6f}', '-i', self.audio_file,
+            *(('-t', f'{duration:.6f}') if duration else ()), *self.ffmpeg_base_args
+        )
+
+    def __enter__(self):
+        self._splitter = self._create_splitter(self.sample_duration, hop_duration=self.hop_duration)
+        self._splitters = {}
+        if self.shards <= 1:
+            return super().__enter__()
+
+        if not self.debug:
+            self.devnull = open(os.devnull, 'w')
+
+        # A duration past the end of the file is clamped, so the shards cover the audio that actually exists
+        end = self.probe_duration()
+        if self.duration:
+            end = min(end, self.start + self.duration)
+
+        chunk_duration = self.chunk_size / (2 * self.sample_rate * self.channels)
+        n_chunks = max(0, math.ceil((end - self.start) / chunk_duration))
+        chunks_per_shard = max(1, math.ceil(n_chunks / self.shards))
+
+        for i in range(0, n_chunks, chunks_per_shard):
+            shard_start = self.start + i * chunk_duration
+            is_last = i + chunks_per_shard >= n_chunks
+            if is_last:
+                self._shards.append(DecoderShard(
+                    self._shard_args(shard_start, end - shard_start if self.duration else None),
+                    stderr=self.devnull))
+            else:
+                # Decode one extra chunk as a margin and trim the output to the exact number of bytes
+                self._shards.append(DecoderShard(
+                    self._shard_args(shard_start, (chunks_per_shard + 1) * chunk_duration),
+                    max_bytes=chunks_per_shard * self.chunk_size, stderr=self.devnull))
+
+        self._shard_index = 0
+        if self._window:
+            self._window.reset()
+
+        return self
+
+    def _read_chunk(self) -> Optional[Tuple[float, bytes]]:
+        if self.shards <= 1:
+            return super()._read_chunk()
+
+        while self._shard_index < len(self._shards):
+            shard = self._shards[self._shard_index]
+            data = shard.read(self.chunk_size)
+            if data:
+                return self._timestamp_chunk(data)
+
+            # A short shard would shift the timestamps and labels of all the following audio
+            if not shard.complete:
+                raise IOError(f'Shard {self._shard_index} of {self.audio_file} decoded {shard.written} bytes '
+                              f'instead of {shard.max_bytes}')
+
+            self._shard_index += 1
+
+        return None
 
-        data = self.ffmpeg.stdout.read(self.bufsize)
-        if data:
-            while self.segments and self.cur_time * 1000 >= self.segments[0][0]:
-                self.cur_label = self.segments.pop(0)[1]
+    def pause(self):
+        super().pause()
+        for shard in self._shards:
+            shard.pause()
 
-            audio = AudioSegment(data, sample_rate=self.sample_rate, channels=self.channels,
-                                 label=self.labels.index(self.cur_label))
+    def resume(self):
+        super().resume()
+        for shard in self._shards:
+            shard.resume()
 
-            self.cur_time += audio.duration
-            return audio
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for shard in self._shards:
+            shard.close()
 
-        raise StopIteration
+        self._shards = []
+        super().__exit__(exc_type, exc_val, exc_tb)
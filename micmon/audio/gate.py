@@ -0,0 +1,100 @@
+import copy
+from typing import Optional, Union
+
+import numpy as np
+
+from micmon.audio.segment import AudioSegment
+from micmon.metrics import metrics
+
+# Full scale of a signed 16-bit PCM sample
+full_scale = float(1 << 15)
+
+
+class EnergyGate:
+    # Cheap pre-filter that decides, from the RMS or peak level of the raw int16 audio, whether a segment
+    # is worth a spectrum calculation and a forward pass. The gate opens when the level reaches threshold_db
+    # (dBFS) and closes when it stays below threshold_db - hysteresis_db for hold_time seconds of audio,
+    # so short pauses within a sound don't cut it. Gated segments are given default_label.
+    def __init__(self, threshold_db: float = -50., hysteresis_db: float = 6., hold_time: float = 2.,
+                 mode: str = 'rms', default_label: Optional[Union[str, int]] = None,
+                 default_confidence: float = 1., name: str = ''):
+        assert mode in ('rms', 'peak'), f'Invalid gate mode: {mode}'
+        assert hysteresis_db >= 0 and hold_time >= 0, 'hysteresis_db and hold_time must be non-negative'
+        self.threshold_db = threshold_db
+        self.hysteresis_db = hysteresis_db
+        self.hold_time = hold_time
+        self.mode = mode
+        self.default_label = default_label
+        self.default_confidence = default_confidence
+        self.name = name
+        self.is_open = False
+        self.total = 0
+        self.gated = 0
+        self._quiet_time = 0.
+        self._last_timestamp: Optional[float] = None
+
+    def clone(self, name: Optional[str] = None) -> 'EnergyGate':
+        # Gate with the same settings and a fresh state, e.g. for another audio stream
+        gate = copy.copy(self)
+        gate.reset()
+        if name is not None:
+            gate.name = name
+        return gate
+
+    def reset(self):
+        self.is_open = False
+        self.total = 0
+        self.gated = 0
+        self._quiet_time = 0.
+        self._last_timestamp = None
+
+    @property
+    def gated_ratio(self) -> float:
+        return self.gated / self.total if self.total else 0.
+
+    def level(self, audio: np.ndarray) -> float:
+        # Level of the audio in dBFS
+        if not len(audio):
+            return -np.inf
+
+        if self.mode == 'peak':
+            value = max(-int(audio.min()), int(audio.max()))
+        else:
+            samples = audio.astype(np.float32)
+            value = np.sqrt(np.dot(samples, samples) / len(samples))
+
+        return 20 * np.log10(value / full_scale) if value > 0 else -np.inf
+
+    def _elapsed(self, segment: AudioSegment) -> float:
+        # Audio time added by the segment: overlapping windows (hop_duration) only add their hop, and a gap in
+        # the timestamps counts at most as one segment
+        elapsed = segment.duration
+        if segment.timestamp is not None and self._last_timestamp is not None \
+                and segment.timestamp > self._last_timestamp:
+            elapsed = min(elapsed, segment.timestamp - self._last_timestamp)
+
+        if segment.timestamp is not None:
+            self._last_timestamp = segment.timestamp
+        return elapsed
+
+    def update(self, segment: AudioSegment) -> bool:
+        # Returns True if the segment should be processed, False if it's gated. Segments must be passed in order.
+        level = self.level(segment.audio)
+        elapsed = self._elapsed(segment)
+        if level >= self.threshold_db:
+            self.is_open = True
+            self._quiet_time = 0.
+        elif self.is_open:
+            if level < self.threshold_db - self.hysteresis_db:
+                self._quiet_time += elapsed
+                if self._quiet_time >= self.hold_time:
+                    self.is_open = False
+            else:
+                self._quiet_time = 0.
+
+        self.total += 1
+        if not self.is_open:
+            self.gated += 1
+
+        metrics.set_gauge('gated_ratio', self.gated_ratio, gate=self.name)
+        return self.is_open
@@ -1,32 +1,94 @@
-from typing import Optional
+from typing import List, Optional, Sequence, Union
 
 import numpy as np
 
+from micmon.metrics import metrics
+from micmon.audio.spectrum import bin_index, bin_spectrum, coeff_range, fft, spectrum_scale, downmix, \
+    split_frames, Binning, batch_spectra as _batch_spectra
+
 
 class AudioSegment:
     default_low_freq = 20
     default_high_freq = 20000
     default_bins = 100
 
-    def __init__(self, data: bytes, sample_rate: int = 44100, channels: int = 1, label: Optional[int] = None):
+    def __init__(self, data: Union[bytes, np.ndarray], sample_rate: int = 44100, channels: int = 1,
+                 label: Optional[int] = None, timestamp: Optional[float] = None):
         self.data = data
-        self.audio = np.frombuffer(data, dtype=np.int16)
+        self.audio = data if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.int16)
         self.sample_rate = sample_rate
         self.channels = channels
         self.duration = len(self.audio) / (sample_rate * channels)
         self.label = label
+        self.timestamp = timestamp
+
+    def copy(self) -> 'AudioSegment':
+        return AudioSegment(self.audio.copy(), sample_rate=self.sample_rate, channels=self.channels,
+                            label=self.label, timestamp=self.timestamp)
+
+    @property
+    def mono(self) -> np.ndarray:
+        return downmix(self.audio, self.channels)
 
     def fft(self, low_freq: int = default_low_freq, high_freq: int = default_high_freq) -> np.ndarray:
-        return np.absolute(np.fft.rfft(self.audio))[low_freq:high_freq]
+        audio = self.mono
+        start, stop = coeff_range(self.sample_rate, len(audio), low_freq, high_freq)
+        return fft(audio)[start:stop]
 
     def spectrum(self, low_freq: int = default_low_freq, high_freq: int = default_high_freq,
                  bins: int = default_bins) -> np.ndarray:
-        fft = self.fft(low_freq=low_freq, high_freq=high_freq)
-        bin_size = int(len(fft) / bins)
-        return np.array([
-            np.average(fft[i * bin_size: i * bin_size + bin_size]) / (self.duration * ((1 << 16) - 1))
-            for i in range(bins)
-        ])
+        start = metrics.start()
+        audio = self.mono
+        index = bin_index(self.sample_rate, len(audio), low_freq, high_freq, bins)
+        spectrum = bin_spectrum(fft(audio), index, scale=spectrum_scale(len(audio)))
+        metrics.observe('spectrum', start, audio_duration=self.duration)
+        return spectrum
+
+    @classmethod
+    def batch_spectrum(cls, segments: Union[Sequence['AudioSegment'], bytes, np.ndarray],
+                       low_freq: int = default_low_freq, high_freq: int = default_high_freq,
+                       bins: int = default_bins, sample_rate: Optional[int] = None, channels: Optional[int] = None,
+                       sample_duration: float = 2.0) -> np.ndarray:
+        return cls.batch_spectra(segments, [(low_freq, high_freq, bins)], sample_rate=sample_rate,
+                                 channels=channels, sample_duration=sample_duration)[0]
+
+    @classmethod
+    def batch_spectra(cls, segments: Union[Sequence['AudioSegment'], bytes, np.ndarray], binnings: Sequence[Binning],
+                      sample_rate: Optional[int] = None, channels: Optional[int] = None,
+                      sample_duration: float = 2.0) -> List[np.ndarray]:
+        # Same as batch_spectrum for several (low_freq, high_freq, bins) binnings at once: the FFT of each
+        # segment is only calculated once, and one (N, bins) matrix is returned for each binning.
+        # Raw audio buffers don't carry their format, so sample_rate and channels are required for them, while
+        # segments use their own.
+        start = metrics.start()
+        if isinstance(segments, (bytes, bytearray, memoryview, np.ndarray)):
+            if sample_rate is None or channels is None:
+                raise ValueError('The sample_rate and channels of a raw audio buffer are required')
+
+            audio = segments if isinstance(segments, np.ndarray) else np.frombuffer(segments, dtype=np.int16)
+            if audio.ndim == 1:
+                audio = split_frames(audio, int(sample_duration * sample_rate) * channels)
+
+            spectra = _batch_spectra(downmix(audio, channels), sample_rate=sample_rate, binnings=binnings)
+            metrics.observe('spectrum', start, items=len(audio), audio_duration=audio.size / (sample_rate * channels))
+            return spectra
+
+        # Segments of different length or format (e.g. the trailing chunk of a file) are transformed in groups
+        groups = {}
+        for i, segment in enumerate(segments):
+            groups.setdefault((segment.sample_rate, segment.channels, len(segment.audio)), []).append(i)
+
+        spectra = [np.empty((len(segments), bins), dtype=np.float32) for _, _, bins in binnings]
+        for (rate, n_channels, _), idx in groups.items():
+            audio = np.stack([segments[i].audio for i in idx])
+            for spectrum, group_spectrum in zip(spectra, _batch_spectra(downmix(audio, n_channels), sample_rate=rate,
+                                                                        binnings=binnings)):
+                spectrum[idx] = group_spectrum
+
+        if start is not None:
+            metrics.observe('spectrum', start, items=len(segments),
+                            audio_duration=sum(segment.duration for segment in segments))
+        return spectra
 
     def plot_audio(self):
         import matplotlib.pyplot as plt
@@ -0,0 +1,82 @@
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+from typing import IO, Optional, Sequence
+
+
+class DecoderShard:
+    # Runs one ffmpeg decoder over a time range of a file and drains its output into a temporary file
+    # in a background thread, so that all the shards can decode in parallel while the consumer reads them
+    # in order. At most max_bytes bytes are kept from the decoder output.
+    read_size = 1 << 16
+
+    def __init__(self, args: Sequence[str], max_bytes: Optional[int] = None, stderr: Optional[IO] = None):
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.read_pos = 0
+        self.done = False
+        self._cond = threading.Condition()
+        self._file = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        try:
+            while self.max_bytes is None or self.written < self.max_bytes:
+                size = self.read_size if self.max_bytes is None else min(self.read_size, self.max_bytes - self.written)
+                data = self.process.stdout.read(size)
+                if not data:
+                    break
+
+                os.pwrite(self._file.fileno(), data, self.written)
+                with self._cond:
+                    self.written += len(data)
+                    self._cond.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+            # The decoder may produce slightly more audio than needed: stop it once the shard is complete
+            if self.process.poll() is None:
+                self.process.terminate()
+
+    @property
+    def complete(self) -> bool:
+        # False if the decoder stopped before producing max_bytes bytes
+        return self.max_bytes is None or self.written >= self.max_bytes
+
+    def pause(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGSTOP)
+
+    def resume(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+
+    def read(self, size: int) -> bytes:
+        # Blocks until size bytes have been decoded, or returns fewer bytes at the end of the shard
+        with self._cond:
+            self._cond.wait_for(lambda: self.written - self.read_pos >= size or self.done)
+            size = min(size, self.written - self.read_pos)
+
+        data = os.pread(self._file.fileno(), size, self.read_pos)
+        self.read_pos += len(data)
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+        self.process.wait()
+        self._thread.join(timeout=5)
+        self._file.close()
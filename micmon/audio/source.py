@@ -1,11 +1,17 @@
 import logging
 import os
+import queue
 import signal
 import subprocess
+import threading
 from abc import ABC
-from typing import Optional, Union, IO
+from typing import Optional, Union, IO, Tuple
 
+import numpy as np
+
+from micmon.audio.buffer import RingBuffer, SlidingWindow
 from micmon.audio.segment import AudioSegment
+from micmon.metrics import metrics
 
 
 class AudioSource(ABC):
@@ -14,37 +20,181 @@ class AudioSource(ABC):
                  sample_rate: int = 44100,
                  channels: int = 1,
                  ffmpeg_bin: str = 'ffmpeg',
-                 debug: bool = False):
+                 debug: bool = False,
+                 buffered: bool = False,
+                 buffer_size: int = 16,
+                 overflow: str = 'drop_oldest',
+                 hop_duration: Optional[float] = None,
+                 pool_size: int = 0,
+                 name: Optional[str] = None):
         self.ffmpeg_bin = ffmpeg_bin
         self.ffmpeg_base_args = (
             '-f', 's16le',
-            '-acodec', 'pcm_s16le', '-ac', str(channels), '-r', str(sample_rate), '-')
+            '-acodec', 'pcm_s16le', '-ac', str(channels), '-ar', str(sample_rate), '-')
 
         self.ffmpeg_args = self.ffmpeg_base_args
 
-        # bufsize = sample_duration * rate * width * channels
-        self.bufsize = int(sample_duration * sample_rate * 2 * 1)
+        # bufsize = sample_duration * rate * width * channels, rounded down to a whole number of audio frames
+        self.bufsize = int(sample_duration * sample_rate) * 2 * channels
         self.ffmpeg: Optional[subprocess.Popen] = None
+        self.hop_duration = hop_duration
         self.sample_duration = sample_duration
         self.sample_rate = sample_rate
         self.channels = channels
         self.debug = debug
+        # Identifies the source in the metrics. Subclasses default it to the device or the file path.
+        self.name = name
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
         self.devnull: Optional[IO] = None
+        self.cur_time = 0.
+
+        # In buffered mode a reader thread drains the ffmpeg pipe into a bounded ring buffer, so capture
+        # keeps going while the consumer is busy processing the previous segments.
+        self.buffered = buffered
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self._buffer: Optional[RingBuffer] = None
+        self._reader: Optional[threading.Thread] = None
+
+        # If hop_duration is set, ffmpeg is read in chunks of hop_duration seconds and each chunk yields a
+        # sample_duration window that overlaps the previous one. Windows are views over a shared sliding
+        # buffer, so the PCM data is never read or copied twice.
+        self._window: Optional[SlidingWindow] = None
+        self.chunk_size = self.bufsize
+        if hop_duration:
+            assert 0 < hop_duration <= sample_duration, 'hop_duration must be between 0 and sample_duration'
+            self.chunk_size = int(hop_duration * sample_rate) * 2 * channels
+            self._window = SlidingWindow(self.bufsize // 2, sample_rate=sample_rate, channels=channels)
+
+        # If pool_size is set, ffmpeg is read with readinto into a ring of preallocated arrays and the segments
+        # are views over them, so no memory is allocated per chunk. A segment's audio stays valid until
+        # pool_size more chunks have been read: copy it if it needs to be kept for longer. With the drop_oldest
+        # policy the reader thread keeps refilling the buffers however far behind the consumer is, so the two
+        # options can't be combined.
+        if pool_size and buffered and overflow == 'drop_oldest':
+            raise ValueError("pool_size can't be used together with buffered=True and overflow='drop_oldest'")
+
+        self.pool_size = pool_size
+        self._pool = [
+            np.empty(self.chunk_size // 2, dtype=np.int16)
+            for _ in range(pool_size + (buffer_size + 1 if buffered and pool_size else 0))
+        ]
+        self._pool_index = 0
+
+    @property
+    def pooled(self) -> bool:
+        # True if the segments are views over the read pool (windows with hop_duration are never overwritten)
+        return bool(self._pool) and not self._window
 
     def __iter__(self):
         return self
 
     def __next__(self) -> AudioSegment:
-        if not self.ffmpeg or self.ffmpeg.poll() is not None:
-            raise StopIteration
+        return self.read()
+
+    def read(self, timeout: Optional[float] = None) -> Optional[AudioSegment]:
+        # Raises StopIteration at the end of the stream. In buffered mode it returns None if no segment
+        # is available within the timeout.
+        start = metrics.start()
+        while True:
+            if self._buffer:
+                try:
+                    item = self._buffer.get(timeout=timeout)
+                except queue.Empty:
+                    return None
+            else:
+                item = self._read_chunk()
+
+            if not item:
+                raise StopIteration
+
+            segment = self._process_chunk(*item)
+            if segment is not None:
+                if start is not None:
+                    self._observe_read(start, segment)
+                return segment
+
+    def _observe_read(self, start: float, segment: AudioSegment):
+        # Time spent waiting for the audio, e.g. on the ffmpeg pipe or on the capture buffer
+        metrics.observe('read', start, audio_duration=segment.duration)
+        if self._buffer:
+            name = self.name or self.__class__.__name__
+            metrics.set_gauge('queue_depth', self._buffer.depth, source=name)
+            metrics.set_gauge('dropped_chunks', self._buffer.dropped, source=name)
+
+    def _process_chunk(self, timestamp: float, data: Union[bytes, np.ndarray]) -> Optional[AudioSegment]:
+        # Returns the segment for a chunk read from ffmpeg, or None if more chunks are needed to fill a window
+        if not self._window:
+            # A trailing chunk shorter than a segment is dropped, like in AudioFile.read_frames: a few
+            # milliseconds of audio don't have enough FFT coefficients for the spectrum bins
+            if (data.nbytes if isinstance(data, np.ndarray) else len(data)) < self.chunk_size:
+                return None
+
+            return self._create_segment(data, timestamp)
+
+        window = self._window.push(data if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.int16),
+                                   timestamp)
+        if window is not None:
+            return self._create_segment(window, self._window.start_time)
+
+    def _read_chunk(self) -> Optional[Tuple[float, bytes]]:
+        # Keep reading after ffmpeg has exited until its output pipe is drained
+        if not self.ffmpeg:
+            return None
+
+        if self._pool:
+            return self._timestamp_chunk(self._read_into(self.ffmpeg.stdout))
 
-        data = self.ffmpeg.stdout.read(self.bufsize)
-        if data:
-            return AudioSegment(data, sample_rate=self.sample_rate, channels=self.channels)
+        return self._timestamp_chunk(self.ffmpeg.stdout.read(self.chunk_size))
 
-        raise StopIteration
+    def _read_into(self, stream: IO) -> np.ndarray:
+        # Fills the next buffer of the pool, handling short reads from the pipe. The last chunk of the stream
+        # may be shorter than chunk_size.
+        buf = self._pool[self._pool_index]
+        self._pool_index = (self._pool_index + 1) % len(self._pool)
+        view = memoryview(buf).cast('B')
+        size = 0
+
+        while size < len(view):
+            n = stream.readinto(view[size:])
+            if not n:
+                break
+
+            size += n
+
+        return buf[:size // 2]
+
+    def _timestamp_chunk(self, data: Union[bytes, np.ndarray]) -> Optional[Tuple[float, Union[bytes, np.ndarray]]]:
+        size = data.nbytes if isinstance(data, np.ndarray) else len(data)
+        if not size:
+            return None
+
+        timestamp = self.cur_time
+        self.cur_time += size / (2 * self.sample_rate * self.channels)
+        return timestamp, data
+
+    def _create_segment(self, data: Union[bytes, np.ndarray], timestamp: float) -> AudioSegment:
+        return AudioSegment(data, sample_rate=self.sample_rate, channels=self.channels, timestamp=timestamp)
+
+    def _reader_loop(self, buffer: RingBuffer):
+        try:
+            while True:
+                item = self._read_chunk()
+                if not item:
+                    break
+
+                buffer.put(item)
+        finally:
+            buffer.close()
+
+    @property
+    def dropped_frames(self) -> int:
+        return self._buffer.dropped if self._buffer else 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._buffer.depth if self._buffer else 0
 
     def __enter__(self):
         kwargs = dict(stdout=subprocess.PIPE)
@@ -53,6 +203,16 @@ class AudioSource(ABC):
             kwargs['stderr'] = self.devnull
 
         self.ffmpeg = subprocess.Popen(self.ffmpeg_args, **kwargs)
+        self._pool_index = 0
+        if self._window:
+            self._window.reset()
+
+        if self.buffered:
+            self._buffer = RingBuffer(self.buffer_size, overflow=self.overflow)
+            self._reader = threading.Thread(target=self._reader_loop, args=(self._buffer,),
+                                            name=f'{self.__class__.__name__}-reader', daemon=True)
+            self._reader.start()
+
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -67,7 +227,17 @@ class AudioSource(ABC):
                 self.ffmpeg.kill()
 
             self.ffmpeg.wait()
-            self.ffmpeg = None
+
+        if self._buffer:
+            # Unblock the reader if it's waiting on a full buffer
+            self._buffer.close()
+
+        if self._reader:
+            self._reader.join(timeout=5)
+            self._reader = None
+
+        self._buffer = None
+        self.ffmpeg = None
 
         if self.devnull:
             self.devnull.close()
@@ -0,0 +1,99 @@
+from collections import namedtuple
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# Maximum value range of a signed 16-bit PCM sample
+sample_range = (1 << 16) - 1
+
+# The spectra are normalized by the number of samples that a frame of the same duration has at this rate, so
+# that the features of a signal don't depend on the rate it was decoded at (and match the original 44.1 kHz
+# features)
+reference_rate = 44100
+
+# Decode rates that can be negotiated, and share of the Nyquist band that is considered usable: the rest is
+# left to the transition band of the resampler's anti-aliasing filter
+standard_rates = (8000, 11025, 16000, 22050, 32000, 44100)
+passband = 0.9
+
+BinIndex = namedtuple('BinIndex', ['start', 'stop', 'offsets', 'counts'])
+
+# Frequency range and number of bins of a spectrum: (low_freq, high_freq, bins)
+Binning = Tuple[int, int, int]
+
+
+def coeff_range(sample_rate: int, n_samples: int, low_freq: int, high_freq: int) -> Tuple[int, int]:
+    # The k-th rFFT coefficient of a frame of n_samples is centered on k * sample_rate / n_samples Hz
+    n_coeffs = n_samples // 2 + 1
+    return (min(int(np.ceil(low_freq * n_samples / sample_rate)), n_coeffs),
+            min(int(np.ceil(high_freq * n_samples / sample_rate)), n_coeffs))
+
+
+@lru_cache(maxsize=128)
+def bin_index(sample_rate: int, n_samples: int, low_freq: int, high_freq: int, bins: int) -> BinIndex:
+    start, stop = coeff_range(sample_rate, n_samples, low_freq, high_freq)
+    if stop - start < bins:
+        raise ValueError(f'The range {low_freq}-{high_freq} Hz spans {stop - start} FFT coefficients at '
+                         f'{sample_rate} Hz/{n_samples} samples, not enough for {bins} bins')
+
+    edges = np.linspace(start, stop, bins + 1).astype(np.intp)
+    offsets = edges[:-1] - start
+    counts = np.diff(edges)
+    offsets.setflags(write=False)
+    counts.setflags(write=False)
+    return BinIndex(start=start, stop=stop, offsets=offsets, counts=counts)
+
+
+def min_sample_rate(high_freq: float, rates: Sequence[int] = standard_rates) -> int:
+    # Lowest decode rate whose usable band still covers high_freq, or the highest rate if none does
+    for rate in sorted(rates):
+        if rate / 2 * passband >= high_freq:
+            return rate
+
+    return max(rates)
+
+
+def spectrum_scale(n_samples: int) -> float:
+    return n_samples / reference_rate * sample_range
+
+
+def fft(audio: np.ndarray) -> np.ndarray:
+    return np.absolute(np.fft.rfft(audio, axis=-1))
+
+
+def bin_spectrum(fft_data: np.ndarray, index: BinIndex, scale: float = 1.) -> np.ndarray:
+    # fft_data can be either a single FFT (1-D) or a batch of FFTs (2-D, one frame per row)
+    sums = np.add.reduceat(fft_data[..., index.start:index.stop], index.offsets, axis=-1)
+    return sums / (index.counts * scale)
+
+
+def downmix(audio: np.ndarray, channels: int = 1) -> np.ndarray:
+    # Average the interleaved channels of one (1-D) or more (2-D) frames into mono
+    if channels == 1:
+        return audio
+
+    n_samples = audio.shape[-1] - (audio.shape[-1] % channels)
+    return audio[..., :n_samples].reshape(*audio.shape[:-1], -1, channels).mean(axis=-1)
+
+
+def split_frames(audio: np.ndarray, frame_len: int) -> np.ndarray:
+    # (N, frame_len) view over a contiguous buffer; trailing samples that don't fill a frame are dropped
+    n_frames = len(audio) // frame_len
+    return audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+
+
+def batch_spectrum(frames: np.ndarray, sample_rate: int, low_freq: int, high_freq: int, bins: int) -> np.ndarray:
+    # frames is a (N, n_samples) matrix of mono frames, transformed with one 2-D rFFT call
+    return batch_spectra(frames, sample_rate, [(low_freq, high_freq, bins)])[0]
+
+
+def batch_spectra(frames: np.ndarray, sample_rate: int, binnings: Sequence[Binning]) -> List[np.ndarray]:
+    # The rFFT of the frames is calculated once and binned in each of the requested ways
+    fft_data = fft(frames)
+    scale = spectrum_scale(frames.shape[-1])
+    return [
+        bin_spectrum(fft_data, bin_index(sample_rate, frames.shape[-1], low_freq, high_freq, bins),
+                     scale=scale).astype(np.float32)
+        for low_freq, high_freq, bins in binnings
+    ]
@@ -1,53 +1,129 @@
+import json
 import os
+from typing import Dict, Optional, Tuple
+
 import numpy as np
 
-from .writer import DatasetWriter
+from .writer import DatasetWriter, StreamingDatasetWriter
+from .collection import DatasetCollection, DatasetFile
+from .quantize import dequantize
 from ..audio import AudioSegment
 
 
 class Dataset:
     def __init__(self, samples: np.ndarray, classes: np.ndarray, validation_split: float = 0.,
-                 low_freq: float = AudioSegment.default_low_freq, high_freq: float = AudioSegment.default_high_freq):
+                 low_freq: float = AudioSegment.default_low_freq, high_freq: float = AudioSegment.default_high_freq,
+                 seed: Optional[int] = None, stratify: bool = False,
+                 scale: Optional[float] = None, offset: Optional[float] = None, sample_rate: Optional[int] = None):
+        # Samples in a compact format (float16, or uint8 with scale and offset) are kept as they are, and
+        # converted to float32 only when the training or validation samples are accessed
         self.samples = samples
+        self.scale = scale
+        self.offset = offset
+        self.sample_rate = sample_rate
         self.classes = classes
         self.labels = np.sort(np.unique(classes))
         self.validation_split = validation_split
         self.low_freq = low_freq
         self.high_freq = high_freq
-        self.train_samples, self.train_classes, self.validation_samples, self.validation_classes = [np.array([])] * 4
+        self.stratify = stratify
+        self._rng = np.random.default_rng(seed)
+        self._pivot = 0
+        self._dequantized: Dict[str, np.ndarray] = {}
+        self.train_classes, self.validation_classes = [np.array([])] * 2
         self.shuffle()
 
     @classmethod
-    def load(cls, npz_path: str, validation_split: float = 0.):
-        dataset = np.load(os.path.abspath(os.path.expanduser(npz_path)))
+    def load(cls, npz_path: str, validation_split: float = 0., **kwargs):
+        npz_path = os.path.abspath(os.path.expanduser(npz_path))
+        if StreamingDatasetWriter.is_dataset_dir(npz_path):
+            with open(os.path.join(npz_path, StreamingDatasetWriter.metadata_file_name), 'r') as f:
+                metadata = json.load(f)
+
+            samples = np.load(os.path.join(npz_path, StreamingDatasetWriter.samples_file_name))
+            StreamingDatasetWriter.check_dtype(samples.dtype, metadata)
+            classes = np.load(os.path.join(npz_path, StreamingDatasetWriter.classes_file_name))
+            # The two files may differ by one block if the writer was interrupted between the two flushes
+            n_samples = min(len(samples), len(classes))
+            return cls(samples=samples[:n_samples],
+                       classes=classes[:n_samples],
+                       validation_split=validation_split,
+                       low_freq=metadata['cutoff_frequencies'][0],
+                       high_freq=metadata['cutoff_frequencies'][1],
+                       scale=metadata.get('scale'),
+                       offset=metadata.get('offset'),
+                       sample_rate=metadata.get('sample_rate'),
+                       **kwargs)
+
+        dataset = np.load(npz_path)
+        metadata = json.loads(str(dataset['metadata'])) if 'metadata' in dataset.files else {}
         return cls(samples=dataset['samples'],
                    classes=dataset['classes'],
                    validation_split=validation_split,
                    low_freq=dataset['cutoff_frequencies'][0],
-                   high_freq=dataset['cutoff_frequencies'][1])
+                   high_freq=dataset['cutoff_frequencies'][1],
+                   scale=metadata.get('scale'),
+                   offset=metadata.get('offset'),
+                   sample_rate=metadata.get('sample_rate'),
+                   **kwargs)
 
     @classmethod
-    def scan(cls, datasets_path, validation_split: float = 0.):
+    def scan(cls, datasets_path, validation_split: float = 0., **kwargs):
         datasets_path = os.path.abspath(os.path.expanduser(datasets_path))
         return [
-            cls.load(os.path.join(datasets_path, file), validation_split=validation_split)
+            cls.load(os.path.join(datasets_path, file), validation_split=validation_split, **kwargs)
             for file in os.listdir(datasets_path)
-            if os.path.isfile(os.path.join(datasets_path, file))
-            and file.endswith('.npz')
+            if (os.path.isfile(os.path.join(datasets_path, file)) and file.endswith('.npz'))
+            or StreamingDatasetWriter.is_dataset_dir(os.path.join(datasets_path, file))
         ]
 
     def shuffle(self):
-        data = np.array([
-            (self.samples[i], self.classes[i])
-            for i in range(len(self.samples))
-        ], dtype=object)
-
-        np.random.shuffle(data)
-        self.samples = np.array([p[0] for p in data])
-        self.classes = np.array([p[1] for p in data])
-
-        pivot = int(len(data) - (self.validation_split * len(data)))
-        self.train_samples = np.array([p[0] for p in data[:pivot]])
-        self.train_classes = np.array([p[1] for p in data[:pivot]])
-        self.validation_samples = np.array([p[0] for p in data[pivot:]])
-        self.validation_classes = np.array([p[1] for p in data[pivot:]])
+        # The samples are reordered with a single gather so that the training set comes first and the
+        # validation set last, and the train/validation arrays are views over the shuffled samples.
+        train_index, validation_index = self._split(self._rng.permutation(len(self.samples)))
+        order = np.concatenate([train_index, validation_index])
+        self.samples = self.samples[order]
+        self.classes = self.classes[order]
+
+        pivot = self._pivot = len(train_index)
+        self._dequantized = {}
+        self.train_classes = self.classes[:pivot]
+        self.validation_classes = self.classes[pivot:]
+
+    @property
+    def train_samples(self) -> np.ndarray:
+        return self._get_samples('train', slice(None, self._pivot))
+
+    @train_samples.setter
+    def train_samples(self, samples: np.ndarray):
+        # Replaces the float32 training samples until the next shuffle
+        self._dequantized['train'] = samples
+
+    @property
+    def validation_samples(self) -> np.ndarray:
+        return self._get_samples('validation', slice(self._pivot, None))
+
+    @validation_samples.setter
+    def validation_samples(self, samples: np.ndarray):
+        self._dequantized['validation'] = samples
+
+    def _get_samples(self, subset: str, rows: slice) -> np.ndarray:
+        if subset not in self._dequantized:
+            self._dequantized[subset] = dequantize(self.samples[rows], self.scale, self.offset)
+
+        return self._dequantized[subset]
+
+    def _split(self, index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.stratify:
+            pivot = int(len(index) - (self.validation_split * len(index)))
+            return index[:pivot], index[pivot:]
+
+        # Take the same share of validation samples from each class, preserving the shuffled order
+        classes = self.classes[index]
+        is_validation = np.zeros(len(index), dtype=bool)
+        for label in self.labels:
+            positions = np.flatnonzero(classes == label)
+            pivot = int(len(positions) - (self.validation_split * len(positions)))
+            is_validation[positions[pivot:]] = True
+
+        return index[~is_validation], index[is_validation]
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .quantize import dequantize
+from .writer import StreamingDatasetWriter
+
+
+class SampleCache:
+    # Keeps the samples of the `size` most recently read datasets: the decompressed samples of .npz files, and
+    # the memory maps of dataset directories. Reading a corpus of datasets then doesn't end up holding all of
+    # it in memory, or one open file descriptor per dataset directory.
+    def __init__(self, size: int = 4):
+        self.size = size
+        self._items: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, load: Callable[[], np.ndarray]) -> np.ndarray:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        value = load()
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > max(self.size, 1):
+                self._items.popitem(last=False)
+
+        return value
+
+
+class DatasetFile:
+    def __init__(self, path: str, cache: Optional[SampleCache] = None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.cache = cache
+        self._rows: Optional[int] = None
+
+        if os.path.isdir(self.path):
+            # Uncompressed dataset directory: the spectra are memory-mapped when they are read, and only the
+            # pages that are actually read are loaded from disk. Until then only the .npy header is read.
+            with open(os.path.join(self.path, StreamingDatasetWriter.metadata_file_name), 'r') as f:
+                self.metadata = json.load(f)
+
+            shape, dtype = self._npy_header(os.path.join(self.path, StreamingDatasetWriter.samples_file_name))
+            StreamingDatasetWriter.check_dtype(dtype, self.metadata)
+            self.classes = np.load(os.path.join(self.path, StreamingDatasetWriter.classes_file_name))
+            self.bins = shape[1]
+            self._rows = shape[0]
+        else:
+            # Compressed .npz datasets can't be memory-mapped: the file is only kept open while it's read, and
+            # the spectra are decompressed on access (and kept in the cache, if any)
+            with np.load(self.path) as npz:
+                self.classes = npz['classes']
+                self.metadata = json.loads(str(npz['metadata'])) if 'metadata' in npz.files \
+                    else {'cutoff_frequencies': npz['cutoff_frequencies'].tolist()}
+
+            self.bins = self.metadata.get('bins') or self._npz_shape('samples')[1]
+
+        self.low_freq, self.high_freq = self.metadata['cutoff_frequencies']
+        self.scale = self.metadata.get('scale')
+        self.offset = self.metadata.get('offset')
+        self.sample_rate = self.metadata.get('sample_rate')
+
+    @staticmethod
+    def _read_header(f) -> Tuple[Tuple[int, ...], np.dtype]:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+            else np.lib.format.read_array_header_2_0
+        shape, _, dtype = read_header(f)
+        return shape, dtype
+
+    @classmethod
+    def _npy_header(cls, path: str) -> Tuple[Tuple[int, ...], np.dtype]:
+        with open(path, 'rb') as f:
+            return cls._read_header(f)
+
+    def _npz_shape(self, name: str) -> Tuple[int, ...]:
+        # Reads the shape of an array from its header, without decompressing it
+        with zipfile.ZipFile(self.path) as archive, archive.open(name + '.npy') as f:
+            return self._read_header(f)[0]
+
+    def _load_samples(self) -> np.ndarray:
+        if self._rows is not None:
+            return np.load(os.path.join(self.path, StreamingDatasetWriter.samples_file_name), mmap_mode='r')
+
+        with np.load(self.path) as npz:
+            return npz['samples']
+
+    @property
+    def samples(self) -> np.ndarray:
+        return self.cache.get(self.path, self._load_samples) if self.cache else self._load_samples()
+
+    def read(self, rows: Union[slice, np.ndarray]) -> np.ndarray:
+        # Reads some rows of the samples as float32, restoring them from the compact formats
+        return dequantize(np.asarray(self.samples[rows]), self.scale, self.offset)
+
+    def __len__(self):
+        # samples.npy and classes.npy may differ by one block if the writer was interrupted
+        if self._rows is not None:
+            return min(self._rows, len(self.classes))
+
+        return len(self.classes)
+
+
+class DatasetCollection:
+    def __init__(self, paths: Sequence[str], cache_size: int = 4):
+        # The decompressed samples of up to cache_size .npz files, or the memory maps of up to cache_size
+        # dataset directories, are kept open. Shuffled access across many .npz files decompresses them over
+        # and over: use uncompressed dataset directories for that.
+        self.cache = SampleCache(cache_size)
+        self.files = [DatasetFile(path, cache=self.cache) for path in paths]
+        self.offsets = np.cumsum([0] + [len(file) for file in self.files])
+        self._labels: Optional[np.ndarray] = None
+
+    @classmethod
+    def scan(cls, datasets_path: str, **kwargs):
+        datasets_path = os.path.abspath(os.path.expanduser(datasets_path))
+        return cls([
+            os.path.join(datasets_path, file)
+            for file in sorted(os.listdir(datasets_path))
+            if (os.path.isfile(os.path.join(datasets_path, file)) and file.endswith('.npz'))
+            or StreamingDatasetWriter.is_dataset_dir(os.path.join(datasets_path, file))
+        ], **kwargs)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def labels(self) -> np.ndarray:
+        if self._labels is None:
+            self._labels = np.unique(np.concatenate([np.unique(file.classes) for file in self.files])) \
+                if self.files else np.array([])
+
+        return self._labels
+
+    @property
+    def cutoff_frequencies(self) -> Tuple[float, float]:
+        assert self.files, 'The collection is empty'
+        return self.files[0].low_freq, self.files[0].high_freq
+
+    @property
+    def bins(self) -> int:
+        return self.files[0].bins if self.files else 0
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        # Decode rate of the audio the datasets were generated from, if it was recorded
+        rates = set(file.sample_rate for file in self.files if file.sample_rate)
+        assert len(rates) <= 1, f'The datasets were generated at different sample rates: {sorted(rates)}'
+        return rates.pop() if rates else None
+
+    def __getitem__(self, index: Union[int, slice, Sequence[int], np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        if isinstance(index, (int, np.integer)):
+            samples, classes = self[np.array([index])]
+            return samples[0], classes[0]
+
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+
+        index = np.asarray(index, dtype=np.int64)
+        index = np.where(index < 0, index + len(self), index)
+        assert not len(index) or (index.min() >= 0 and index.max() < len(self)), 'Index out of range'
+
+        file_index = np.searchsorted(self.offsets, index, side='right') - 1
+        local_index = index - self.offsets[file_index]
+        bins = self.bins
+        samples = np.empty((len(index), bins), dtype=np.float32)
+        classes = np.empty(len(index), dtype=np.int64)
+
+        for i in np.unique(file_index):
+            file = self.files[i]
+            positions = np.flatnonzero(file_index == i)
+            # Reading the rows in ascending order keeps the access to memory-mapped files sequential
+            order = np.argsort(local_index[positions], kind='stable')
+            positions = positions[order]
+            rows = local_index[positions]
+            samples[positions] = file.read(rows)
+            classes[positions] = file.classes[rows]
+
+        return samples, classes
+
+    def batches(self, batch_size: int = 32, shuffle: bool = False, seed: Optional[int] = None) \
+            -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        index = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for i in range(0, len(index), batch_size):
+            yield self[index[i:i + batch_size]]
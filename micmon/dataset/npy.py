@@ -0,0 +1,58 @@
+import struct
+from typing import IO, Optional, Tuple
+
+import numpy as np
+
+
+class NpyAppender:
+    # Writes a .npy file whose first dimension can grow. The header is padded to a fixed length, so it
+    # can be rewritten in place with the new shape every time a block is appended, and the file can be
+    # loaded (or memory-mapped) with np.load at any point.
+    header_len = 128
+
+    def __init__(self, path: str, dtype: np.dtype, shape: Tuple[int, ...] = ()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.rows = 0
+        self._file: Optional[IO] = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.rows, *self.shape),
+        })
+
+        # Magic string + version (1.0) + header length, then the header dict padded with spaces
+        prefix = b'\x93NUMPY\x01\x00'
+        header_size = self.header_len - len(prefix) - 2
+        header = header.ljust(header_size - 1).encode('latin1') + b'\n'
+        assert len(header) == header_size, f'The .npy header for shape {(self.rows, *self.shape)} is too long'
+
+        self._file.seek(0)
+        self._file.write(prefix + struct.pack('<H', header_size) + header)
+        self._file.seek(0, 2)
+
+    def append(self, data: np.ndarray):
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        assert data.shape[1:] == self.shape, f'Expected rows of shape {self.shape}, got {data.shape[1:]}'
+        self._file.write(data.tobytes())
+        self.rows += len(data)
+
+    def flush(self):
+        self._write_header()
+        self._file.flush()
+
+    def close(self):
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
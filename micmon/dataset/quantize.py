@@ -0,0 +1,43 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Storage formats of the spectra: float32 (default), float16 or uint8 with a per-file scale and offset
+sample_dtypes = ('float32', 'float16', 'uint8')
+
+
+def quantize(samples: np.ndarray, dtype: str = 'float32') -> Tuple[np.ndarray, Optional[float], Optional[float]]:
+    # Returns the samples converted to dtype and, for uint8, the scale and offset to restore them as
+    # samples ~= data * scale + offset
+    assert dtype in sample_dtypes, f'Unsupported sample dtype: {dtype}'
+    if dtype != 'uint8':
+        return np.asarray(samples, dtype=dtype), None, None
+
+    low = float(samples.min()) if samples.size else 0.
+    high = float(samples.max()) if samples.size else 0.
+    scale = (high - low) / 255 if high > low else 1.
+    return quantize_uint8(samples, scale, low), scale, low
+
+
+def quantize_uint8(samples: np.ndarray, scale: float, offset: float) -> np.ndarray:
+    return np.clip(np.rint((samples - offset) / scale), 0, 255).astype(np.uint8)
+
+
+def dequantize(data: np.ndarray, scale: Optional[float] = None, offset: Optional[float] = None) -> np.ndarray:
+    if data.dtype == np.float32:
+        return data
+
+    samples = data.astype(np.float32)
+    if scale is not None:
+        samples *= np.float32(scale)
+        samples += np.float32(offset or 0.)
+
+    return samples
+
+
+def class_dtype(classes: np.ndarray) -> np.dtype:
+    # Smallest integer type that can hold the class indices
+    if not len(classes):
+        return np.dtype(np.uint8)
+
+    return np.result_type(np.min_scalar_type(int(classes.min())), np.min_scalar_type(int(classes.max())))
@@ -1,35 +1,240 @@
+import json
 import os
 import pathlib
+from typing import List, Optional, Sequence, Tuple
+
 import numpy as np
 
 from micmon.audio import AudioSegment
+from micmon.dataset.npy import NpyAppender
+from micmon.dataset.quantize import class_dtype, quantize, quantize_uint8, sample_dtypes
+from micmon.metrics import metrics
 
 
 class DatasetWriter:
     def __init__(self, path: str,
                  low_freq: int = AudioSegment.default_low_freq,
                  high_freq: int = AudioSegment.default_high_freq,
-                 bins: int = AudioSegment.default_bins):
+                 bins: int = AudioSegment.default_bins,
+                 batch_size: int = 64,
+                 dtype: str = 'float32',
+                 sample_duration: Optional[float] = None,
+                 sample_rate: Optional[int] = None):
+        # With dtype='float16' or 'uint8' (with a per-file scale and offset) the dataset is stored in a compact
+        # format, and the classes are stored with the smallest integer type that can hold them.
+        # sample_duration and sample_rate are saved in the metadata, and inferred from the audio if not set.
+        assert dtype in sample_dtypes, f'Unsupported sample dtype: {dtype}'
         self.path = os.path.abspath(os.path.expanduser(path))
         self.low_freq = low_freq
         self.high_freq = high_freq
         self.bins = bins
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.sample_duration = sample_duration
+        self.sample_rate = sample_rate
+        self.scale: Optional[float] = None
+        self.offset: Optional[float] = None
         self.samples = []
         self.classes = []
+        self._pending = []
 
     def __add__(self, sample: AudioSegment):
-        self.samples.append(sample.spectrum(low_freq=self.low_freq, high_freq=self.high_freq, bins=self.bins))
-        self.classes.append(sample.label)
+        # Audio before the first label has no class and can't be used for training
+        if sample.label is None:
+            return self
+
+        self._set_format(sample.sample_rate, sample.duration)
+        self._pending.append(sample)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
         return self
 
+    def flush(self):
+        if not self._pending:
+            return
+
+        start = metrics.start()
+        samples = AudioSegment.batch_spectrum(self._pending, low_freq=self.low_freq,
+                                              high_freq=self.high_freq, bins=self.bins)
+        classes = [sample.label for sample in self._pending]
+        audio_duration = sum(sample.duration for sample in self._pending) if start is not None else 0.
+        self._pending = []
+        self._write(samples, classes)
+        metrics.observe('writer', start, items=len(classes), audio_duration=audio_duration)
+
+    def add_frames(self, frames: np.ndarray, labels: np.ndarray, sample_rate: int, channels: int):
+        # Bulk counterpart of `writer += segment` for the (N, frame_len) frames returned by
+        # AudioFile.read_frames. The frames don't carry their format, so the sample rate and the number of
+        # channels they were decoded with must be passed. Frames with a negative label are skipped.
+        self.flush()
+        self._set_format(sample_rate, frames.shape[1] / (sample_rate * channels))
+        keep = np.flatnonzero(labels >= 0)
+        for i in range(0, len(keep), self.batch_size):
+            start = metrics.start()
+            idx = keep[i:i + self.batch_size]
+            samples = AudioSegment.batch_spectrum(frames[idx], low_freq=self.low_freq, high_freq=self.high_freq,
+                                                  bins=self.bins, sample_rate=sample_rate, channels=channels)
+            self._write(samples, labels[idx].tolist())
+            metrics.observe('writer', start, items=len(idx),
+                            audio_duration=len(idx) * frames.shape[1] / (sample_rate * channels))
+
+    def add_spectra(self, samples: np.ndarray, labels: np.ndarray):
+        # Adds (N, bins) spectra that were already calculated, e.g. through AudioSegment.batch_spectra for
+        # several writers at once. Spectra with a negative label are skipped.
+        assert samples.shape[1] == self.bins, f'Expected {self.bins} bins, got {samples.shape[1]}'
+        self.flush()
+        keep = np.flatnonzero(labels >= 0)
+        if len(keep):
+            self._write(samples[keep], labels[keep].tolist())
+
+    def _set_format(self, sample_rate: int, sample_duration: float):
+        if self.sample_rate is None:
+            self.sample_rate = sample_rate
+        if self.sample_duration is None:
+            self.sample_duration = sample_duration
+
+    @property
+    def metadata(self) -> dict:
+        return {
+            'cutoff_frequencies': [self.low_freq, self.high_freq],
+            'bins': self.bins,
+            'sample_duration': self.sample_duration,
+            'sample_rate': self.sample_rate,
+            'dtype': self.dtype,
+            'scale': self.scale,
+            'offset': self.offset,
+        }
+
+    def _write(self, samples: np.ndarray, classes: Sequence[int]):
+        self.samples.append(samples)
+        self.classes.extend(classes)
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
         pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        samples, self.scale, self.offset = quantize(
+            np.concatenate(self.samples) if self.samples else np.empty((0, self.bins), dtype=np.float32),
+            self.dtype)
+
+        classes = np.array(self.classes, dtype=np.int64)
+        if self.dtype != 'float32':
+            classes = classes.astype(class_dtype(classes))
+
         np.savez_compressed(self.path,
-                            samples=np.array(self.samples),
-                            classes=np.array(self.classes),
-                            cutoff_frequencies=np.array([self.low_freq, self.high_freq]))
+                            samples=samples,
+                            classes=classes,
+                            cutoff_frequencies=np.array([self.low_freq, self.high_freq]),
+                            metadata=np.array(json.dumps(self.metadata)))
 
         self.samples = []
+        self.classes = []
+
+
+class StreamingDatasetWriter(DatasetWriter):
+    # Writes the dataset to a directory with an appendable samples.npy/classes.npy pair and a metadata.json
+    # file. Each batch of spectra is written to disk as soon as it's calculated, so memory usage doesn't
+    # depend on the length of the audio, and the data written up to the last flush survives a crash.
+    samples_file_name = 'samples.npy'
+    classes_file_name = 'classes.npy'
+    metadata_file_name = 'metadata.json'
+    compact_block_size = 1 << 16
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._samples_file: Optional[NpyAppender] = None
+        self._classes_file: Optional[NpyAppender] = None
+
+    @classmethod
+    def is_dataset_dir(cls, path: str) -> bool:
+        return os.path.isfile(os.path.join(path, cls.samples_file_name))
+
+    @property
+    def files(self) -> List[str]:
+        return [
+            os.path.join(self.path, file)
+            for file in (self.samples_file_name, self.classes_file_name, self.metadata_file_name)
+        ]
+
+    def _write(self, samples: np.ndarray, classes: Sequence[int]):
+        self._samples_file.append(samples)
+        self._classes_file.append(np.array(classes))
+        self._samples_file.flush()
+        self._classes_file.flush()
+
+    def _write_metadata(self, dtype: str, replace: bool = True):
+        # The metadata is written to a temporary file that replaces metadata.json in one step
+        with open(self.files[2] + '.tmp', 'w') as f:
+            json.dump({**self.metadata, 'dtype': dtype}, f)
+
+        if replace:
+            os.replace(self.files[2] + '.tmp', self.files[2])
+
+    @classmethod
+    def check_dtype(cls, dtype: np.dtype, metadata: dict):
+        # The compact samples and their metadata are replaced in two steps: if the process died in between,
+        # the samples can't be interpreted
+        if dtype != np.dtype(metadata.get('dtype', 'float32')):
+            raise ValueError(f'The samples are stored as {dtype}, but the metadata says '
+                             f'{metadata.get("dtype", "float32")}: the dataset was not written completely')
+
+    def __enter__(self):
+        samples_file, classes_file, metadata_file = self.files
+        pathlib.Path(self.path).mkdir(parents=True, exist_ok=True)
+        self.scale = self.offset = None
+        self._write_metadata('float32')
+        self._samples_file = NpyAppender(samples_file, dtype=np.float32, shape=(self.bins,))
+        self._classes_file = NpyAppender(classes_file, dtype=np.int64)
+        return self
+
+    def _compact(self):
+        # The data is streamed to disk as float32/int64, so that it can be read back if the process is
+        # interrupted, and converted to the compact format when the writer is closed
+        samples_file, classes_file, metadata_file = self.files
+        samples = np.load(samples_file, mmap_mode='r')
+        classes = np.load(classes_file, mmap_mode='r')
+        n_samples = min(len(samples), len(classes))
+        blocks = range(0, n_samples, self.compact_block_size)
+
+        def block_range(data: np.ndarray) -> Tuple[float, float]:
+            return (min((float(data[i:min(i + self.compact_block_size, n_samples)].min()) for i in blocks),
+                        default=0.),
+                    max((float(data[i:min(i + self.compact_block_size, n_samples)].max()) for i in blocks),
+                        default=0.))
+
+        if self.dtype == 'uint8':
+            low, high = block_range(samples)
+            self.scale = (high - low) / 255 if high > low else 1.
+            self.offset = low
+
+        classes_dtype = class_dtype(np.array(block_range(classes), dtype=np.int64))
+
+        with NpyAppender(samples_file + '.tmp', dtype=self.dtype, shape=(self.bins,)) as samples_out, \
+                NpyAppender(classes_file + '.tmp', dtype=classes_dtype) as classes_out:
+            for i in blocks:
+                block = np.asarray(samples[i:min(i + self.compact_block_size, n_samples)])
+                samples_out.append(quantize_uint8(block, self.scale, self.offset) if self.dtype == 'uint8'
+                                   else block)
+                classes_out.append(classes[i:min(i + self.compact_block_size, n_samples)])
+
+        del samples, classes
+        self._write_metadata(self.dtype, replace=False)
+        os.replace(samples_file + '.tmp', samples_file)
+        os.replace(classes_file + '.tmp', classes_file)
+        os.replace(metadata_file + '.tmp', metadata_file)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        for file in (self._samples_file, self._classes_file):
+            if file:
+                file.close()
+
+        self._samples_file = None
+        self._classes_file = None
+        if self.dtype != 'float32':
+            self._compact()
+        else:
+            self._write_metadata(self.dtype)
@@ -0,0 +1,296 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def escape_label(value) -> str:
+    # Label values such as file paths can contain characters that must be escaped in the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class StageStats:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.items = 0
+        self.audio_duration = 0.
+        self.total_time = 0.
+
+    def observe(self, elapsed: float, items: int, audio_duration: float):
+        self.counts[bisect.bisect_left(self.buckets, elapsed)] += 1
+        self.count += 1
+        self.items += items
+        self.audio_duration += audio_duration
+        self.total_time += elapsed
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the histogram bucket that contains the q-th quantile of the latencies
+        if not self.count:
+            return 0.
+
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+        return float('inf')
+
+    def to_dict(self, uptime: float) -> dict:
+        return {
+            'count': self.count,
+            'items': self.items,
+            'audio_duration': self.audio_duration,
+            'total_time': self.total_time,
+            'mean_latency': self.total_time / self.count if self.count else 0.,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            # Throughput of the stage alone, and rate at which it's actually processing items
+            'items_per_sec': self.items / self.total_time if self.total_time else 0.,
+            'rate': self.items / uptime if uptime else 0.,
+            'rtf': self.total_time / self.audio_duration if self.audio_duration else None,
+        }
+
+
+class Metrics:
+    # Collects per-stage latency histograms, throughput, real-time factor and gauges such as queue depths.
+    # It's disabled by default: the instrumented code calls start() and gets None, and observe() returns
+    # immediately, so the overhead is one attribute check per call. Once enabled, the registered sinks are
+    # notified every `interval` seconds.
+    def __init__(self, buckets: Sequence[float] = default_buckets):
+        self.buckets = tuple(buckets)
+        self.enabled = False
+        self.sinks: List['MetricsSink'] = []
+        self.started_at = time.monotonic()
+        self._stages: Dict[str, StageStats] = {}
+        self._gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reporter: Optional[threading.Thread] = None
+
+    def start(self) -> Optional[float]:
+        return time.perf_counter() if self.enabled else None
+
+    def observe(self, stage: str, start: Optional[float], items: int = 1, audio_duration: float = 0.):
+        if start is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = StageStats(self.buckets)
+            stats.observe(elapsed, items, audio_duration)
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def enable(self, *sinks: 'MetricsSink', interval: float = 10.):
+        self.disable()
+        self.reset()
+        self.sinks = list(sinks)
+        for sink in self.sinks:
+            sink.attach(self)
+
+        self.enabled = True
+        if self.sinks and interval:
+            self._stop.clear()
+            self._reporter = threading.Thread(target=self._report_loop, args=(interval,),
+                                              name='micmon-metrics', daemon=True)
+            self._reporter.start()
+
+    def disable(self):
+        self.enabled = False
+        self._stop.set()
+        if self._reporter:
+            self._reporter.join()
+            self._reporter = None
+
+        if self.sinks:
+            self.report()
+
+        for sink in self.sinks:
+            sink.close()
+
+        self.sinks = []
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._gauges = {}
+            self.started_at = time.monotonic()
+
+    def report(self):
+        for sink in self.sinks:
+            try:
+                sink.report(self)
+            except Exception as e:
+                logger.warning(f'Error while reporting metrics to {sink.__class__.__name__}: {e}')
+
+    def _report_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            self.report()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            uptime = time.monotonic() - self.started_at
+            return {
+                'uptime': uptime,
+                'stages': {stage: stats.to_dict(uptime) for stage, stats in self._stages.items()},
+                'gauges': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in self._gauges.items()
+                ],
+            }
+
+    def prometheus(self, prefix: str = 'micmon') -> str:
+        # Renders the metrics in the Prometheus text exposition format
+        with self._lock:
+            lines = [
+                f'# HELP {prefix}_stage_latency_seconds Latency of each processing stage',
+                f'# TYPE {prefix}_stage_latency_seconds histogram',
+            ]
+
+            for stage, stats in self._stages.items():
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), stats.counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {total}')
+                lines.append(f'{prefix}_stage_latency_seconds_sum{{stage="{stage}"}} {stats.total_time}')
+                lines.append(f'{prefix}_stage_latency_seconds_count{{stage="{stage}"}} {stats.count}')
+
+            for name, attr, kind, description in (
+                ('stage_items_total', 'items', 'counter', 'Number of items (segments) processed by each stage'),
+                ('stage_audio_seconds_total', 'audio_duration', 'counter',
+                 'Duration of the audio processed by each stage'),
+            ):
+                lines.append(f'# HELP {prefix}_{name} {description}')
+                lines.append(f'# TYPE {prefix}_{name} {kind}')
+                for stage, stats in self._stages.items():
+                    lines.append(f'{prefix}_{name}{{stage="{stage}"}} {getattr(stats, attr)}')
+
+            lines.append(f'# HELP {prefix}_stage_realtime_factor Processing time divided by the audio duration')
+            lines.append(f'# TYPE {prefix}_stage_realtime_factor gauge')
+            for stage, stats in self._stages.items():
+                if stats.audio_duration:
+                    lines.append(f'{prefix}_stage_realtime_factor{{stage="{stage}"}} '
+                                 f'{stats.total_time / stats.audio_duration}')
+
+            for name in sorted(set(name for name, _ in self._gauges)):
+                lines.append(f'# TYPE {prefix}_{name} gauge')
+                for (name_, labels), value in self._gauges.items():
+                    if name_ == name:
+                        label_str = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels)
+                        lines.append(f'{prefix}_{name}{{{label_str}}} {value}' if label_str
+                                     else f'{prefix}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsSink(ABC):
+    def attach(self, metrics: Metrics):
+        pass
+
+    @abstractmethod
+    def report(self, metrics: Metrics):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LogSink(MetricsSink):
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def report(self, metrics: Metrics):
+        snapshot = metrics.snapshot()
+        for stage, stats in snapshot['stages'].items():
+            logger.log(self.level, f'{stage}: {stats["items"]} segments, {stats["rate"]:.1f} segments/s, '
+                                   f'p50 {stats["p50"] * 1000:.1f} ms, p95 {stats["p95"] * 1000:.1f} ms' +
+                       (f', RTF {stats["rtf"]:.4f}' if stats['rtf'] is not None else ''))
+
+        for gauge in snapshot['gauges']:
+            labels = ','.join(f'{key}={value}' for key, value in gauge['labels'].items())
+            logger.log(self.level, f'{gauge["name"]}{f"[{labels}]" if labels else ""}: {gauge["value"]}')
+
+
+class CallbackSink(MetricsSink):
+    def __init__(self, callback: Callable[[dict], None]):
+        self.callback = callback
+
+    def report(self, metrics: Metrics):
+        self.callback(metrics.snapshot())
+
+
+class PrometheusFileSink(MetricsSink):
+    # Writes the metrics to a file in the Prometheus text format, e.g. for the node_exporter textfile collector
+    def __init__(self, path: str):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def report(self, metrics: Metrics):
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(metrics.prometheus())
+        os.replace(tmp_file, self.path)
+
+
+class PrometheusHTTPSink(MetricsSink):
+    # Serves the metrics in the Prometheus text format on http://host:port/metrics. The metrics are rendered
+    # on each request, so the reporting interval doesn't matter.
+    def __init__(self, port: int = 9464, host: str = '127.0.0.1'):
+        self._metrics: Optional[Metrics] = None
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics') or not sink._metrics:
+                    self.send_error(404)
+                    return
+
+                body = sink._metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name='micmon-metrics-http', daemon=True)
+        self._thread.start()
+
+    def attach(self, metrics: Metrics):
+        self._metrics = metrics
+
+    def report(self, metrics: Metrics):
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Metrics instance used by the instrumented micmon code
+metrics = Metrics()
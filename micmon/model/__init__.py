@@ -1,50 +1,141 @@
 import json
+import logging
 import os
 import pathlib
+import time
 import numpy as np
 
-from typing import List, Optional
-from tensorflow.keras import Sequential
-from tensorflow.keras.layers import Layer
-from tensorflow.keras.models import load_model, Model as _Model
+from typing import Dict, List, Optional, Sequence, TYPE_CHECKING, Union
 
 from micmon.audio import AudioSegment
-from micmon.dataset import Dataset
+from micmon.dataset import Dataset, DatasetCollection, StreamingDatasetWriter
+from micmon.model.base import BaseModel
+from micmon.model.runtime import NumpyModel
+from micmon.model.monitor import Monitor
+from micmon.model.fanout import FanOut
 
+if TYPE_CHECKING:
+    from tensorflow.keras.layers import Layer
+    from tensorflow.keras.models import Model as _Model
 
-class Model:
+logger = logging.getLogger(__name__)
+
+
+# TensorFlow is only imported when a Keras model is actually created, trained or loaded, so applications
+# that only run exported models through NumpyModel don't pay for it.
+class Model(BaseModel):
     labels_file_name = 'labels.json'
     freq_file_name = 'freq.json'
+    sample_rate_file_name = 'sample_rate.json'
 
     # noinspection PyShadowingNames
-    def __init__(self, layers: Optional[List[Layer]] = None, labels: Optional[List[str]] = None,
-                 model: Optional[_Model] = None,
+    def __init__(self, layers: Optional[List['Layer']] = None, labels: Optional[List[str]] = None,
+                 model: Optional['_Model'] = None,
                  optimizer='adam',
                  loss='sparse_categorical_crossentropy',
                  metrics=('accuracy',),
                  low_freq: int = AudioSegment.default_low_freq,
-                 high_freq: int = AudioSegment.default_high_freq):
+                 high_freq: int = AudioSegment.default_high_freq,
+                 sample_rate: Optional[int] = None):
         assert layers or model
         self.label_names = labels
         self.cutoff_frequencies = (int(low_freq), int(high_freq))
+        self.sample_rate = sample_rate
+        self.startup_times: Dict[str, float] = {}
+        self._predict_fn = None
 
         if layers:
+            from tensorflow.keras import Sequential
             self._model = Sequential(layers)
             self._model.compile(optimizer=optimizer, loss=loss, metrics=list(metrics))
         else:
             self._model = model
 
-    def fit(self, dataset: Dataset, *args, **kwargs):
-        return self._model.fit(dataset.train_samples, dataset.train_classes, *args, **kwargs)
-
-    def evaluate(self, dataset: Dataset, *args, **kwargs):
-        return self._model.evaluate(dataset.validation_samples, dataset.validation_classes, *args, **kwargs)
-
-    def predict(self, audio: AudioSegment):
-        spectrum = audio.spectrum(low_freq=self.cutoff_frequencies[0], high_freq=self.cutoff_frequencies[1])
-        output = self._model.predict(np.array([spectrum]))
-        prediction = int(np.argmax(output))
-        return self.label_names[prediction] if self.label_names else prediction
+    @staticmethod
+    def _as_collection(dataset: Union[DatasetCollection, str, Sequence[str]]) -> DatasetCollection:
+        if isinstance(dataset, DatasetCollection):
+            return dataset
+
+        if isinstance(dataset, str):
+            path = os.path.abspath(os.path.expanduser(dataset))
+            if os.path.isdir(path) and not StreamingDatasetWriter.is_dataset_dir(path):
+                return DatasetCollection.scan(path)
+
+            return DatasetCollection([path])
+
+        return DatasetCollection(dataset)
+
+    def fit(self, dataset: Union[Dataset, DatasetCollection, str, Sequence[str]], *args,
+            batch_size: int = 32, validation_split: float = 0., shuffle_buffer: int = 10000,
+            cycle_length: int = 4, seed: Optional[int] = None, **kwargs):
+        # A Dataset is trained in memory. A DatasetCollection, a datasets directory or a list of dataset
+        # files are streamed through a tf.data pipeline, so a single call trains on the whole corpus.
+        # The decode rate of the training data is recorded, so that the audio is decoded at the same rate
+        # at inference time
+        if isinstance(dataset, Dataset):
+            self.sample_rate = dataset.sample_rate or self.sample_rate
+            return self._model.fit(dataset.train_samples, dataset.train_classes, *args,
+                                   batch_size=batch_size, **kwargs)
+
+        from micmon.model.pipeline import input_pipeline
+        collection = self._as_collection(dataset)
+        self.sample_rate = collection.sample_rate or self.sample_rate
+        pipeline_args = dict(batch_size=batch_size, validation_split=validation_split, seed=seed)
+        train_data = input_pipeline(collection, subset='train' if validation_split else 'all',
+                                    shuffle_buffer=shuffle_buffer, cycle_length=cycle_length, **pipeline_args)
+
+        if validation_split:
+            kwargs['validation_data'] = input_pipeline(collection, subset='validation', shuffle=False,
+                                                       **pipeline_args)
+
+        return self._model.fit(train_data, *args, **kwargs)
+
+    def evaluate(self, dataset: Union[Dataset, DatasetCollection, str, Sequence[str]], *args,
+                 batch_size: int = 32, validation_split: float = 0., **kwargs):
+        if isinstance(dataset, Dataset):
+            return self._model.evaluate(dataset.validation_samples, dataset.validation_classes, *args,
+                                        batch_size=batch_size, **kwargs)
+
+        from micmon.model.pipeline import input_pipeline
+        return self._model.evaluate(
+            input_pipeline(self._as_collection(dataset), batch_size=batch_size, shuffle=False,
+                           validation_split=validation_split, subset='validation' if validation_split else 'all'),
+            *args, **kwargs)
+
+    @property
+    def bins(self) -> int:
+        try:
+            return int(self._model.input_shape[-1])
+        except (AttributeError, TypeError, ValueError):
+            return AudioSegment.default_bins
+
+    def _forward(self, spectra: np.ndarray) -> np.ndarray:
+        if not self._predict_fn:
+            # The input signature has a variable batch size and a fixed number of bins, so the model is traced
+            # once and later calls with a different batch size don't trigger a retrace.
+            import tensorflow as tf
+            self._predict_fn = tf.function(
+                lambda x: self._model(x, training=False),
+                input_signature=[tf.TensorSpec(shape=(None, self.bins), dtype=tf.float32)])
+
+        return self._predict_fn(np.asarray(spectra, dtype=np.float32)).numpy()
+
+    def warmup(self, batch_sizes: Sequence[int] = (1,), steady_runs: int = 10) -> Dict[str, float]:
+        # Traces the predict function and allocates its buffers for the expected batch sizes, so that the first
+        # real prediction doesn't pay for it. It records the latency of the first and of the subsequent calls.
+        t = time.perf_counter()
+        self._forward(np.zeros((batch_sizes[0], self.bins), dtype=np.float32))
+        self.startup_times['first_predict'] = time.perf_counter() - t
+
+        for batch_size in batch_sizes:
+            self._forward(np.zeros((batch_size, self.bins), dtype=np.float32))
+
+        t = time.perf_counter()
+        for _ in range(steady_runs):
+            self._forward(np.zeros((batch_sizes[0], self.bins), dtype=np.float32))
+
+        self.startup_times['steady_predict'] = (time.perf_counter() - t) / steady_runs
+        return self.startup_times
 
     def save(self, path: str, *args, **kwargs):
         path = os.path.abspath(os.path.expanduser(path))
@@ -66,8 +157,39 @@ class Model:
             with open(freq_file, 'w') as f:
                 json.dump(self.cutoff_frequencies, f)
 
+        if self.sample_rate:
+            sample_rate_file = os.path.join(model_dir, self.sample_rate_file_name)
+            with open(sample_rate_file, 'w') as f:
+                json.dump(self.sample_rate, f)
+
+    def export_numpy(self, path: str):
+        # Exports the weights of a stack of Dense layers, together with the labels, the cutoff frequencies and
+        # the sample rate, to a .npz file that can be run without TensorFlow through NumpyModel.load
+        arrays = {}
+        activations = []
+
+        for layer in self._model.layers:
+            layer_type = layer.__class__.__name__
+            if layer_type in ('InputLayer', 'Dropout'):
+                continue
+
+            assert layer_type == 'Dense', f'Only Dense layers can be exported, got {layer_type}'
+            weights = layer.get_weights()
+            arrays[f'weights_{len(activations)}'] = weights[0]
+            if len(weights) > 1:
+                arrays[f'bias_{len(activations)}'] = weights[1]
+
+            activations.append(layer.activation.__name__)
+
+        path = os.path.abspath(os.path.expanduser(path))
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, **arrays, activations=np.array(activations),
+                 labels=np.array(self.label_names or [], dtype=str),
+                 cutoff_frequencies=np.array(self.cutoff_frequencies),
+                 **({'sample_rate': np.array(self.sample_rate)} if self.sample_rate else {}))
+
     @classmethod
-    def load(cls, path: str, *args, **kwargs):
+    def load(cls, path: str, *args, warmup: bool = True, batch_sizes: Sequence[int] = (1,), **kwargs):
         path = os.path.abspath(os.path.expanduser(path))
         is_file = path.endswith('.h5') or path.endswith('.pb')
         if is_file:
@@ -75,11 +197,19 @@ class Model:
         else:
             model_dir = path
 
+        t = time.perf_counter()
+        from tensorflow.keras.models import load_model
+        import_time = time.perf_counter() - t
+
+        t = time.perf_counter()
         model = load_model(path, *args, **kwargs)
+        load_time = time.perf_counter() - t
         labels_file = os.path.join(model_dir, cls.labels_file_name)
         freq_file = os.path.join(model_dir, cls.freq_file_name)
+        sample_rate_file = os.path.join(model_dir, cls.sample_rate_file_name)
         label_names = []
         frequencies = []
+        sample_rate = None
 
         if os.path.isfile(labels_file):
             with open(labels_file, 'r') as f:
@@ -89,4 +219,16 @@ class Model:
             with open(freq_file, 'r') as f:
                 frequencies = json.load(f)
 
-        return cls(model=model, labels=label_names, low_freq=frequencies[0], high_freq=frequencies[1])
+        if os.path.isfile(sample_rate_file):
+            with open(sample_rate_file, 'r') as f:
+                sample_rate = json.load(f)
+
+        model = cls(model=model, labels=label_names, low_freq=frequencies[0], high_freq=frequencies[1],
+                    sample_rate=sample_rate)
+        model.startup_times.update({'import': import_time, 'load': load_time})
+        if warmup:
+            model.warmup(batch_sizes)
+
+        logger.info('Model loaded from {}: {}'.format(
+            path, ', '.join(f'{stage}: {1000 * seconds:.1f} ms' for stage, seconds in model.startup_times.items())))
+        return model
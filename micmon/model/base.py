@@ -0,0 +1,160 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from micmon.audio import AudioSegment, AudioSource, EnergyGate
+from micmon.audio.spectrum import min_sample_rate
+from micmon.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BaseModel(ABC):
+    label_names: Optional[List[str]] = None
+    cutoff_frequencies: Tuple[int, int] = (AudioSegment.default_low_freq, AudioSegment.default_high_freq)
+    bins: int = AudioSegment.default_bins
+    sample_rate: Optional[int] = None
+    _sample_rate_warned = False
+
+    @property
+    def decode_rate(self) -> int:
+        # Rate the audio should be decoded at for this model: the rate of its training data if it's known,
+        # otherwise the lowest standard rate that covers its high cutoff frequency
+        return self.sample_rate or min_sample_rate(self.cutoff_frequencies[1])
+
+    def check_sample_rate(self, segments: Sequence[AudioSegment]):
+        # The features are scaled to be comparable across sample rates, but audio decoded at a different rate
+        # than the training data isn't guaranteed to give the same predictions. Warns once per model.
+        if not self.sample_rate or self._sample_rate_warned:
+            return
+
+        rates = set(segment.sample_rate for segment in segments) - {self.sample_rate}
+        if rates:
+            self._sample_rate_warned = True
+            logger.warning(f'The model was trained on audio decoded at {self.sample_rate} Hz, but it received '
+                           f'audio at {min(rates)} Hz: decode the audio at sample_rate=model.decode_rate')
+
+    @abstractmethod
+    def _forward(self, spectra: np.ndarray) -> np.ndarray:
+        # Maps a (N, bins) matrix of spectra to a (N, n_labels) matrix of class probabilities
+        raise NotImplementedError
+
+    def predict(self, audio: AudioSegment, gate: Optional[EnergyGate] = None):
+        return self.predict_many([audio], gate=gate)[0][0]
+
+    def default_prediction(self, gate: EnergyGate) -> Tuple[Union[str, int], float]:
+        # Prediction given to the segments discarded by the gate
+        label = gate.default_label
+        if label is None:
+            label = self.label_names[0] if self.label_names else 0
+
+        return label, gate.default_confidence
+
+    def predict_many(self, segments: Sequence[AudioSegment], gate: Optional[EnergyGate] = None,
+                     gated: Optional[Sequence[bool]] = None) -> List[Tuple[Union[str, int], float]]:
+        # If a gate is passed, the segments it discards skip the spectrum calculation and the model and get
+        # the gate's default label. gated can be used to pass the gate decisions if they were already taken.
+        assert gate or gated is None, 'The gate decisions require a gate'
+        if not segments:
+            return []
+
+        if gate and gated is None:
+            gated = [not gate.update(segment) for segment in segments]
+
+        results = [self.default_prediction(gate) if gate else None] * len(segments)
+        if gated is not None and any(gated):
+            segments = [segment for segment, is_gated in zip(segments, gated) if not is_gated]
+            positions = [i for i, is_gated in enumerate(gated) if not is_gated]
+            if not segments:
+                return results
+        else:
+            positions = range(len(segments))
+
+        self.check_sample_rate(segments)
+        start = metrics.start()
+        spectra = AudioSegment.batch_spectrum(segments, low_freq=self.cutoff_frequencies[0],
+                                              high_freq=self.cutoff_frequencies[1], bins=self.bins)
+        for i, prediction in zip(positions, self.predict_spectra(spectra)):
+            results[i] = prediction
+
+        if start is not None:
+            metrics.observe('predict', start, items=len(segments),
+                            audio_duration=sum(segment.duration for segment in segments))
+        return results
+
+    def predict_spectra(self, spectra: np.ndarray) -> List[Tuple[Union[str, int], float]]:
+        # Predictions for a (N, bins) matrix of spectra calculated with the model's cutoff frequencies and bins
+        start = metrics.start()
+        output = self._forward(spectra)
+        metrics.observe('inference', start, items=len(spectra))
+        predictions = np.argmax(output, axis=1)
+        return [
+            (self.label_names[prediction] if self.label_names else int(prediction), float(output[i, prediction]))
+            for i, prediction in enumerate(predictions)
+        ]
+
+    def predict_stream(self, source: Iterable[AudioSegment], batch_size: int = 32,
+                       flush_timeout: Optional[float] = None, gate: Optional[EnergyGate] = None) \
+            -> Iterator[Tuple[Optional[float], Union[str, int], float]]:
+        # A batch is scored either when it's full or, if flush_timeout is set, when its oldest segment has been
+        # waiting for more than flush_timeout seconds. Use a small timeout on live sources to bound the latency.
+        # Buffered audio sources are polled with a timeout, so a partial batch is flushed even if no new
+        # segments arrive. Segments discarded by the gate are returned right away if no batch is pending.
+        for batch, gated in batch_stream(source, batch_size=batch_size, flush_timeout=flush_timeout, gate=gate):
+            yield from self._predict_batch(batch, gate, gated)
+
+    def _predict_batch(self, batch: Sequence[AudioSegment], gate: Optional[EnergyGate] = None,
+                       gated: Optional[Sequence[bool]] = None):
+        predictions = self.predict_many(batch, gate=gate, gated=gated if gate else None)
+        for segment, (label, confidence) in zip(batch, predictions):
+            yield segment.timestamp, label, confidence
+
+
+def batch_stream(source: Iterable[AudioSegment], batch_size: int = 32, flush_timeout: Optional[float] = None,
+                 gate: Optional[EnergyGate] = None) -> Iterator[Tuple[List[AudioSegment], List[bool]]]:
+    # Groups the segments of a source into batches, and yields each batch with the gate decisions of its
+    # segments. See BaseModel.predict_stream for the batching rules. A segment discarded by the gate while
+    # no batch is pending is yielded right away as a batch of its own.
+    read = source.read if isinstance(source, AudioSource) else None
+    # The oldest segment of a batch must still be valid when the batch is full
+    copy = isinstance(source, AudioSource) and source.pooled and source.pool_size < batch_size
+    segments = iter(source)
+    batch = []
+    gated = []
+    deadline = None
+
+    while True:
+        try:
+            if read:
+                segment = read(timeout=max(0., deadline - time.monotonic()) if deadline is not None else None)
+            else:
+                segment = next(segments)
+        except StopIteration:
+            break
+
+        if segment is not None:
+            is_gated = bool(gate) and not gate.update(segment)
+            if is_gated and not batch:
+                yield [segment], [True]
+                continue
+
+            if copy:
+                segment = segment.copy()
+
+            if not batch and flush_timeout is not None:
+                deadline = time.monotonic() + flush_timeout
+
+            batch.append(segment)
+            gated.append(is_gated)
+
+        if batch and (len(batch) >= batch_size or (deadline is not None and time.monotonic() >= deadline)):
+            yield batch, gated
+            batch = []
+            gated = []
+            deadline = None
+
+    if batch:
+        yield batch, gated
@@ -0,0 +1,84 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from micmon.audio import AudioSegment, EnergyGate
+from micmon.audio.spectrum import Binning
+from micmon.metrics import metrics
+from micmon.model.base import BaseModel, batch_stream
+
+Prediction = Tuple[Union[str, int], float]
+
+
+class FanOut:
+    # Scores the segments of one audio source with several models, e.g. different detectors listening to the
+    # same microphone. The FFT of each segment is calculated once, it's binned once for each distinct
+    # (low_freq, high_freq, bins) among the models, and the same features are passed to all the models that
+    # use them, so each additional model only costs its forward pass.
+    def __init__(self, models: Union[Sequence[BaseModel], Dict[str, BaseModel]]):
+        self.models: Dict[str, BaseModel] = {}
+        for name, model in (models.items() if isinstance(models, dict) else enumerate(models)):
+            self.add(str(name), model)
+
+    def add(self, name: str, model: BaseModel):
+        assert name not in self.models, f'A model named {name} is already registered'
+        self.models[name] = model
+
+    def remove(self, name: str):
+        del self.models[name]
+
+    @staticmethod
+    def binning(model: BaseModel) -> Binning:
+        return model.cutoff_frequencies[0], model.cutoff_frequencies[1], model.bins
+
+    @property
+    def binnings(self) -> List[Binning]:
+        # Distinct binnings of the registered models, in registration order
+        return list(dict.fromkeys(self.binning(model) for model in self.models.values()))
+
+    @property
+    def decode_rate(self) -> int:
+        # Lowest sample rate that serves all the models
+        assert self.models, 'No models are registered'
+        return max(model.decode_rate for model in self.models.values())
+
+    def predict_many(self, segments: Sequence[AudioSegment], gate: Optional[EnergyGate] = None,
+                     gated: Optional[Sequence[bool]] = None) -> Dict[str, List[Prediction]]:
+        # Returns the predictions of each model for the segments. The segments discarded by the gate get the
+        # default prediction of each model.
+        assert gate or gated is None, 'The gate decisions require a gate'
+        if gate and gated is None:
+            gated = [not gate.update(segment) for segment in segments]
+
+        results = {
+            name: [model.default_prediction(gate) if gate else None] * len(segments)
+            for name, model in self.models.items()
+        }
+
+        positions = [i for i in range(len(segments)) if gated is None or not gated[i]]
+        if not positions or not self.models:
+            return results
+
+        start = metrics.start()
+        segments = [segments[i] for i in positions]
+        for model in self.models.values():
+            model.check_sample_rate(segments)
+
+        binnings = self.binnings
+        features = dict(zip(binnings, AudioSegment.batch_spectra(segments, binnings)))
+        for name, model in self.models.items():
+            for i, prediction in zip(positions, model.predict_spectra(features[self.binning(model)])):
+                results[name][i] = prediction
+
+        if start is not None:
+            metrics.observe('predict', start, items=len(segments),
+                            audio_duration=sum(segment.duration for segment in segments))
+        return results
+
+    def predict_stream(self, source: Iterable[AudioSegment], batch_size: int = 32,
+                       flush_timeout: Optional[float] = None, gate: Optional[EnergyGate] = None) \
+            -> Iterator[Tuple[Optional[float], Dict[str, Prediction]]]:
+        # Yields (timestamp, {model name: (label, confidence)}) for each segment. The batching rules are the
+        # same as in BaseModel.predict_stream.
+        for batch, gated in batch_stream(source, batch_size=batch_size, flush_timeout=flush_timeout, gate=gate):
+            results = self.predict_many(batch, gate=gate, gated=gated if gate else None)
+            for i, segment in enumerate(batch):
+                yield segment.timestamp, {name: predictions[i] for name, predictions in results.items()}
@@ -0,0 +1,137 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from micmon.audio import AudioSegment, AudioSource, EnergyGate
+from micmon.metrics import metrics
+from micmon.model.base import BaseModel
+
+
+class Monitor:
+    # Reads many audio sources concurrently in a single process and scores their segments with shared
+    # forward passes of one model. Each source is read by its own thread, which is blocked on the ffmpeg
+    # pipe most of the time, while the calling thread batches the segments from all the sources.
+    def __init__(self, model: BaseModel,
+                 sources: Union[Sequence[AudioSource], Dict[str, AudioSource]],
+                 batch_size: int = 32,
+                 flush_timeout: Optional[float] = 0.5,
+                 queue_size: int = 256,
+                 gate: Optional[EnergyGate] = None,
+                 name: Optional[str] = None):
+        self.model = model
+        self.name = name or self.__class__.__name__
+        self.sources = dict(sources) if isinstance(sources, dict) else {
+            str(i): source for i, source in enumerate(sources)
+        }
+
+        # Each source gets its own copy of the gate, since its state depends on the history of the stream
+        self.gate = gate
+        self.gates = {name: gate.clone(name=name) for name in self.sources} if gate else {}
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._readers: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._entered = ExitStack()
+
+    def _put(self, item: Tuple[str, Optional[AudioSegment]]) -> bool:
+        # Waits for room in the queue, unless the monitor is being stopped
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _read(self, name: str, source: AudioSource):
+        try:
+            for segment in source:
+                # Segments can wait in the queue and in the batch for longer than the read pool keeps them
+                if source.pooled:
+                    segment = segment.copy()
+
+                if not self._put((name, segment)):
+                    break
+        except Exception as e:
+            # Errors raised while the sources are being closed are expected
+            if not self._stop.is_set():
+                self.logger.warning(f'Error while reading from audio source {name}: {e}')
+        finally:
+            # Nobody waits for the end of the stream once the monitor is stopped
+            self._put((name, None))
+
+    def __enter__(self):
+        self._stop.clear()
+        self._entered = ExitStack()
+        try:
+            for name, source in self.sources.items():
+                self._entered.enter_context(source)
+                reader = threading.Thread(target=self._read, args=(name, source),
+                                          name=f'{self.__class__.__name__}-{name}', daemon=True)
+                reader.start()
+                self._readers.append(reader)
+        except BaseException:
+            # Close the sources that were already started
+            self.__exit__(*sys.exc_info())
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._entered.__exit__(exc_type, exc_val, exc_tb)
+
+        # Drain the queue so that readers blocked on it can terminate
+        while any(reader.is_alive() for reader in self._readers):
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        self._readers = []
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[float], Union[str, int], float]]:
+        # Yields (source name, timestamp, label, confidence) tuples as the batches are scored
+        active = len(self.sources)
+        batch: List[Tuple[str, AudioSegment]] = []
+        gated: List[bool] = []
+        deadline = None
+
+        while active or batch:
+            timeout = max(0., deadline - time.monotonic()) if deadline is not None else None
+            try:
+                name, segment = self._queue.get(timeout=timeout) if active else (None, None)
+                if segment is None and name is not None:
+                    active -= 1
+                elif segment is not None:
+                    is_gated = bool(self.gate) and not self.gates[name].update(segment)
+                    if is_gated and not batch:
+                        yield (name, segment.timestamp, *self.model.default_prediction(self.gate))
+                        continue
+
+                    if not batch and self.flush_timeout is not None:
+                        deadline = time.monotonic() + self.flush_timeout
+                    batch.append((name, segment))
+                    gated.append(is_gated)
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.batch_size or not active or
+                          (deadline is not None and time.monotonic() >= deadline)):
+                metrics.set_gauge('queue_depth', self._queue.qsize(), source=self.name)
+                predictions = self.model.predict_many([segment for _, segment in batch], gate=self.gate,
+                                                      gated=gated if self.gate else None)
+                for (name, segment), (label, confidence) in zip(batch, predictions):
+                    yield name, segment.timestamp, label, confidence
+
+                batch = []
+                gated = []
+                deadline = None
@@ -0,0 +1,60 @@
+from typing import Optional
+
+import numpy as np
+import tensorflow as tf
+
+from micmon.dataset import DatasetCollection
+
+
+def input_pipeline(collection: DatasetCollection,
+                   batch_size: int = 32,
+                   shuffle: bool = True,
+                   shuffle_buffer: int = 10000,
+                   cycle_length: int = 4,
+                   block_size: int = 256,
+                   validation_split: float = 0.,
+                   subset: str = 'all',
+                   seed: Optional[int] = None) -> tf.data.Dataset:
+    # Streams (samples, classes) batches from all the files in the collection. Blocks of rows are read from
+    # cycle_length files at a time, mixed through a bounded shuffle buffer and prefetched while the model
+    # trains on the previous batch, so only a few blocks per file are in memory at any time.
+    # Like in Keras, validation_split holds out the last rows of each file: subset='train' reads the
+    # rows before the split point, subset='validation' the ones after it.
+    assert subset in ('all', 'train', 'validation'), f'Invalid subset: {subset}'
+    assert collection.files, 'The dataset collection is empty'
+    bins = collection.bins
+    # Each of the files read in parallel keeps its decompressed samples in the cache while it's being read
+    collection.cache.size = max(collection.cache.size, cycle_length)
+
+    def row_range(file) -> range:
+        pivot = int(len(file) - (validation_split * len(file)))
+        if subset == 'train':
+            return range(0, pivot)
+        if subset == 'validation':
+            return range(pivot, len(file))
+        return range(0, len(file))
+
+    def read_blocks(file_index):
+        file = collection.files[int(file_index)]
+        rows = row_range(file)
+        for start in range(rows.start, rows.stop, block_size):
+            stop = min(start + block_size, rows.stop)
+            yield file.read(slice(start, stop)), \
+                np.asarray(file.classes[start:stop], dtype=np.int64)
+
+    signature = (tf.TensorSpec(shape=(None, bins), dtype=tf.float32),
+                 tf.TensorSpec(shape=(None,), dtype=tf.int64))
+
+    files = tf.data.Dataset.range(len(collection.files))
+    if shuffle:
+        files = files.shuffle(len(collection.files), seed=seed)
+
+    data = files.interleave(
+        lambda i: tf.data.Dataset.from_generator(read_blocks, args=(i,), output_signature=signature),
+        cycle_length=cycle_length, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle
+    ).unbatch()
+
+    if shuffle:
+        data = data.shuffle(shuffle_buffer, seed=seed)
+
+    return data.batch(batch_size).prefetch(tf.data.AUTOTUNE)
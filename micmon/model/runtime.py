@@ -0,0 +1,67 @@
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from micmon.audio import AudioSegment
+from micmon.model.base import BaseModel
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return x / x.sum(axis=-1, keepdims=True)
+
+
+class NumpyModel(BaseModel):
+    # Runs the forward pass of a stack of Dense layers exported through Model.export_numpy with plain
+    # NumPy matrix products. It doesn't depend on TensorFlow.
+    activations: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+        'linear': lambda x: x,
+        'relu': lambda x: np.maximum(x, 0),
+        'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+        'tanh': np.tanh,
+        'softmax': _softmax,
+    }
+
+    def __init__(self, layers: List[Tuple[np.ndarray, Optional[np.ndarray], str]],
+                 labels: Optional[List[str]] = None,
+                 low_freq: int = AudioSegment.default_low_freq,
+                 high_freq: int = AudioSegment.default_high_freq,
+                 sample_rate: Optional[int] = None):
+        for _, _, activation in layers:
+            assert activation in self.activations, f'Unsupported activation function: {activation}'
+
+        self.layers = [
+            (weights.astype(np.float32), bias.astype(np.float32) if bias is not None else None, activation)
+            for weights, bias, activation in layers
+        ]
+
+        self.label_names = labels
+        self.cutoff_frequencies = (int(low_freq), int(high_freq))
+        self.sample_rate = sample_rate
+        self.bins = self.layers[0][0].shape[0]
+
+    def _forward(self, spectra: np.ndarray) -> np.ndarray:
+        x = np.asarray(spectra, dtype=np.float32)
+        for weights, bias, activation in self.layers:
+            x = x @ weights
+            if bias is not None:
+                x += bias
+            x = self.activations[activation](x)
+
+        return x
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(os.path.abspath(os.path.expanduser(path))) as data:
+            activations = [str(activation) for activation in data['activations']]
+            layers = [
+                (data[f'weights_{i}'], data[f'bias_{i}'] if f'bias_{i}' in data.files else None, activation)
+                for i, activation in enumerate(activations)
+            ]
+
+            labels = [str(label) for label in data['labels']]
+            low_freq, high_freq = data['cutoff_frequencies']
+            sample_rate = int(data['sample_rate']) if 'sample_rate' in data.files else None
+
+        return cls(layers, labels=labels or None, low_freq=low_freq, high_freq=high_freq, sample_rate=sample_rate)
@@ -0,0 +1,415 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from micmon.audio import AudioFile, AudioSegment
+from micmon.audio.spectrum import bin_index, bin_spectrum, coeff_range, downmix, fft, spectrum_scale
+from micmon.dataset import Dataset, DatasetWriter, StreamingDatasetWriter
+from micmon.model import NumpyModel
+
+logger = logging.getLogger(__name__)
+defaults = {
+    'duration': 120.,
+    'sample_duration': 2.0,
+    'sample_rate': 44100,
+    'channels': 1,
+    'low_freq': 250,
+    'high_freq': 7500,
+    'bins': 100,
+    'label_period': 10,
+    'rows': 100000,
+    'batch_size': 32,
+    'ffmpeg_bin': 'ffmpeg',
+}
+
+stages = ('decode', 'decode_bulk', 'spectrum', 'batch_spectrum', 'binning_loop', 'binning', 'writer',
+          'streaming_writer', 'dataset_load', 'dataset_shuffle_loop', 'dataset_shuffle', 'predict_numpy',
+          'predict_keras', 'cold_start_numpy', 'cold_start_keras')
+
+# Run in a new interpreter by the cold start stages: times the import of micmon, the loading of the model and
+# the first prediction, and prints the time and the peak memory usage (in KB on Linux)
+cold_start_script = '''
+import resource, sys, time
+start = time.perf_counter()
+import numpy as np
+from micmon.audio import AudioSegment
+from micmon.model import Model, NumpyModel
+model = (NumpyModel if sys.argv[1] == 'numpy' else Model).load(sys.argv[2])
+model.predict(AudioSegment(np.load(sys.argv[3]), sample_rate=int(sys.argv[4]), channels=int(sys.argv[5])))
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def generate_audio(audio_dir: str, duration: float = defaults['duration'],
+                   sample_rate: int = defaults['sample_rate'],
+                   label_period: int = defaults['label_period'],
+                   ffmpeg_bin: str = defaults['ffmpeg_bin']) -> str:
+    # Creates a labelled audio sample with pink noise and a 1 kHz tone that is switched on and off every
+    # label_period seconds, so the benchmark doesn't depend on any recordings. Returns the audio file path.
+    os.makedirs(audio_dir, exist_ok=True)
+    audio_file = os.path.join(audio_dir, 'audio.wav')
+    subprocess.check_call([
+        ffmpeg_bin, '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'anoisesrc=d={duration}:c=pink:r={sample_rate}:a=0.05',
+        '-f', 'lavfi', '-i', f'sine=f=1000:d={duration}:r={sample_rate}',
+        '-filter_complex', f"[1]volume='lt(mod(t,{2 * label_period}),{label_period})':eval=frame[tone];"
+                           f"[0][tone]amix=inputs=2:duration=first",
+        '-ac', '1', '-ar', str(sample_rate), audio_file
+    ])
+
+    with open(os.path.join(audio_dir, 'labels.json'), 'w') as f:
+        json.dump({
+            f'{t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}': 'positive' if (t // label_period) % 2 == 0
+            else 'negative'
+            for t in range(0, int(duration), label_period)
+        }, f)
+
+    return audio_file
+
+
+def measure(func: Callable[[], int], audio_duration: Optional[float] = None) -> dict:
+    # Runs func, which returns the number of processed items, and reports its throughput. If the stage
+    # processes audio, the real-time factor is the processing time divided by the duration of the audio.
+    start = time.perf_counter()
+    items = func()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    result = {'elapsed': elapsed, 'items': items, 'items_per_sec': items / elapsed}
+    if audio_duration:
+        result['audio_duration'] = audio_duration
+        result['rtf'] = elapsed / audio_duration
+
+    return result
+
+
+def random_model(bins: int, low_freq: int, high_freq: int, seed: int = 0) -> NumpyModel:
+    rng = np.random.default_rng(seed)
+    sizes = [bins, 2 * bins, bins, 2]
+    return NumpyModel([
+        (rng.standard_normal((n_in, n_out)).astype(np.float32) / np.sqrt(n_in), np.zeros(n_out, np.float32),
+         'softmax' if i == len(sizes) - 2 else 'relu')
+        for i, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:]))
+    ], labels=['negative', 'positive'], low_freq=low_freq, high_freq=high_freq)
+
+
+def keras_model(model: NumpyModel):
+    # Keras model with the same architecture and weights as the NumPy one
+    from tensorflow.keras import layers
+    from micmon.model import Model
+
+    keras_layers = [layers.Input(shape=(model.bins,))]
+    for weights, bias, activation in model.layers:
+        keras_layers.append(layers.Dense(weights.shape[1], activation=activation))
+
+    keras = Model(keras_layers, labels=model.label_names, low_freq=model.cutoff_frequencies[0],
+                  high_freq=model.cutoff_frequencies[1])
+    keras._model.set_weights([w for weights, bias, _ in model.layers for w in (weights, bias)])
+    keras.warmup(batch_sizes=(1, 32))
+    return keras
+
+
+def save_numpy_model(model: NumpyModel, path: str):
+    # Same format as Model.export_numpy, which needs TensorFlow
+    arrays = {}
+    for i, (weights, bias, _) in enumerate(model.layers):
+        arrays[f'weights_{i}'] = weights
+        if bias is not None:
+            arrays[f'bias_{i}'] = bias
+
+    np.savez(path, **arrays, activations=np.array([activation for _, _, activation in model.layers]),
+             labels=np.array(model.label_names or [], dtype=str), cutoff_frequencies=np.array(model.cutoff_frequencies))
+
+
+def cold_start(runtime: str, model_path: str, segment_path: str, sample_rate: int, channels: int) -> dict:
+    output = subprocess.check_output([sys.executable, '-c', cold_start_script, runtime, model_path, segment_path,
+                                      str(sample_rate), str(channels)], stderr=subprocess.DEVNULL)
+    elapsed, max_rss = output.decode().strip().split('\n')[-1].split()
+    return {'elapsed': float(elapsed), 'items': 1, 'items_per_sec': 1 / float(elapsed),
+            'max_rss_mb': int(max_rss) / 1024}
+
+
+def predict_latency(model, segments: Sequence[AudioSegment], runs: int = 20) -> float:
+    # Median latency of a single-segment prediction, in seconds
+    latencies = []
+    for segment in segments[:runs]:
+        start = time.perf_counter()
+        model.predict(segment)
+        latencies.append(time.perf_counter() - start)
+
+    return float(np.median(latencies)) if latencies else 0.
+
+
+def run_benchmarks(work_dir: str,
+                   duration: float = defaults['duration'],
+                   sample_duration: float = defaults['sample_duration'],
+                   sample_rate: int = defaults['sample_rate'],
+                   channels: int = defaults['channels'],
+                   low_freq: int = defaults['low_freq'],
+                   high_freq: int = defaults['high_freq'],
+                   bins: int = defaults['bins'],
+                   label_period: int = defaults['label_period'],
+                   rows: int = defaults['rows'],
+                   batch_size: int = defaults['batch_size'],
+                   ffmpeg_bin: str = defaults['ffmpeg_bin'],
+                   selected: Sequence[str] = stages) -> dict:
+    unknown = set(selected).difference(stages)
+    assert not unknown, f'Unknown benchmark stages: {", ".join(sorted(unknown))}'
+    features = dict(low_freq=low_freq, high_freq=high_freq, bins=bins)
+    source_args = dict(sample_duration=sample_duration, sample_rate=sample_rate, channels=channels,
+                       ffmpeg_bin=ffmpeg_bin)
+
+    logger.info(f'Generating {duration} seconds of synthetic audio')
+    audio_file = generate_audio(os.path.join(work_dir, 'audio'), duration=duration, sample_rate=sample_rate,
+                                label_period=label_period, ffmpeg_bin=ffmpeg_bin)
+
+    with AudioFile(audio_file, **source_args) as reader:
+        frames = reader.read_frames()
+
+    segments = [AudioSegment(frame, sample_rate=sample_rate, channels=channels) for frame in frames.audio]
+    audio_duration = len(segments) * sample_duration
+    results: Dict[str, dict] = {}
+
+    def decode() -> int:
+        with AudioFile(audio_file, **source_args) as reader_:
+            return sum(1 for _ in reader_)
+
+    def decode_bulk() -> int:
+        with AudioFile(audio_file, **source_args) as reader_:
+            return len(reader_.read_frames().audio)
+
+    def spectrum() -> int:
+        for segment in segments:
+            segment.spectrum(**features)
+        return len(segments)
+
+    def batch_spectrum() -> int:
+        return len(AudioSegment.batch_spectrum(frames.audio, sample_rate=sample_rate, channels=channels,
+                                               **features))
+
+    # The binning stages share the FFTs of the frames, so they only measure the binning of the coefficients
+    n_samples = frames.audio.shape[1] // channels
+    fft_data = fft(downmix(frames.audio, channels)) if {'binning_loop', 'binning'}.intersection(selected) else None
+
+    def binning_loop() -> int:
+        # Original implementation: one np.average call per bin of each frame
+        start, stop = coeff_range(sample_rate, n_samples, low_freq, high_freq)
+        bin_size = (stop - start) // bins
+        scale = spectrum_scale(n_samples)
+        for row in fft_data:
+            coeffs = row[start:stop]
+            np.array([np.average(coeffs[i * bin_size:(i + 1) * bin_size]) / scale for i in range(bins)])
+        return len(fft_data)
+
+    def binning() -> int:
+        return len(bin_spectrum(fft_data, bin_index(sample_rate, n_samples, low_freq, high_freq, bins),
+                                scale=spectrum_scale(n_samples)))
+
+    def writer(writer_class) -> Callable[[], int]:
+        def run() -> int:
+            path = os.path.join(work_dir, writer_class.__name__ + ('' if writer_class is StreamingDatasetWriter
+                                                                   else '.npz'))
+            with writer_class(path, **features) as writer_:
+                writer_.add_frames(frames.audio, frames.labels, sample_rate=sample_rate, channels=channels)
+            return int(np.count_nonzero(frames.labels >= 0))
+        return run
+
+    # Synthetic spectra for the dataset stages, so their size doesn't depend on the audio duration
+    dataset_file = os.path.join(work_dir, 'dataset.npz')
+    dataset: List[Dataset] = []
+    if {'dataset_load', 'dataset_shuffle_loop', 'dataset_shuffle'}.intersection(selected):
+        rng = np.random.default_rng(0)
+        np.savez_compressed(dataset_file, samples=rng.random((rows, bins), dtype=np.float32),
+                            classes=rng.integers(0, 2, rows), cutoff_frequencies=np.array([low_freq, high_freq]))
+
+    def dataset_load() -> int:
+        dataset[:] = [Dataset.load(dataset_file, validation_split=0.3)]
+        return len(dataset[0].samples)
+
+    def dataset_shuffle_loop() -> int:
+        # Original implementation: the rows are shuffled as an object array of (sample, class) pairs, and the
+        # samples, the classes and the train/validation sets are rebuilt from it with list comprehensions
+        if not dataset:
+            dataset_load()
+        data = np.array([(dataset[0].samples[i], dataset[0].classes[i]) for i in range(len(dataset[0].samples))],
+                        dtype=object)
+        np.random.shuffle(data)
+        np.array([p[0] for p in data])
+        np.array([p[1] for p in data])
+        pivot = int(len(data) - (dataset[0].validation_split * len(data)))
+        for subset in (data[:pivot], data[pivot:]):
+            np.array([p[0] for p in subset])
+            np.array([p[1] for p in subset])
+        return len(data)
+
+    def dataset_shuffle() -> int:
+        if not dataset:
+            dataset_load()
+        dataset[0].shuffle()
+        return len(dataset[0].samples)
+
+    model = random_model(bins, low_freq, high_freq)
+
+    def predict(model_) -> Callable[[], int]:
+        def run() -> int:
+            for i in range(0, len(segments), batch_size):
+                model_.predict_many(segments[i:i + batch_size])
+            return len(segments)
+        return run
+
+    for stage in [stage for stage in stages if stage in selected]:
+        if stage == 'decode':
+            results[stage] = measure(decode, audio_duration)
+        elif stage == 'decode_bulk':
+            results[stage] = measure(decode_bulk, audio_duration)
+        elif stage == 'spectrum':
+            results[stage] = measure(spectrum, audio_duration)
+        elif stage == 'batch_spectrum':
+            results[stage] = measure(batch_spectrum, audio_duration)
+        elif stage == 'binning_loop':
+            results[stage] = measure(binning_loop, audio_duration)
+        elif stage == 'binning':
+            results[stage] = measure(binning, audio_duration)
+        elif stage == 'writer':
+            results[stage] = measure(writer(DatasetWriter), audio_duration)
+        elif stage == 'streaming_writer':
+            results[stage] = measure(writer(StreamingDatasetWriter), audio_duration)
+        elif stage == 'dataset_load':
+            results[stage] = measure(dataset_load)
+        elif stage == 'dataset_shuffle_loop':
+            results[stage] = measure(dataset_shuffle_loop)
+        elif stage == 'dataset_shuffle':
+            results[stage] = measure(dataset_shuffle)
+        elif stage == 'predict_numpy':
+            results[stage] = measure(predict(model), audio_duration)
+            results[stage]['latency'] = predict_latency(model, segments)
+        elif stage == 'predict_keras':
+            try:
+                keras = keras_model(model)
+            except ImportError as e:
+                logger.warning(f'Skipping the predict_keras benchmark: {e}')
+                continue
+
+            results[stage] = measure(predict(keras), audio_duration)
+            results[stage]['latency'] = predict_latency(keras, segments)
+        elif stage in ('cold_start_numpy', 'cold_start_keras'):
+            segment_path = os.path.join(work_dir, 'segment.npy')
+            np.save(segment_path, segments[0].audio)
+            if stage == 'cold_start_numpy':
+                model_path = os.path.join(work_dir, 'model.npz')
+                save_numpy_model(model, model_path)
+            else:
+                try:
+                    model_path = os.path.join(work_dir, 'keras', 'model.h5')
+                    keras_model(model).save(model_path, overwrite=True)
+                except ImportError as e:
+                    logger.warning(f'Skipping the cold_start_keras benchmark: {e}')
+                    continue
+
+            results[stage] = cold_start(stage.split('_')[-1], model_path, segment_path, sample_rate, channels)
+
+        logger.info(f'{stage}: {results[stage]["elapsed"]:.3f} s')
+
+    return {
+        'config': dict(duration=duration, sample_duration=sample_duration, sample_rate=sample_rate,
+                       channels=channels, label_period=label_period, rows=rows, batch_size=batch_size,
+                       **features),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+        },
+        'stages': results,
+    }
+
+
+def format_results(results: dict) -> str:
+    lines = [f'{"stage":<22}{"items":>10}{"time (s)":>12}{"items/s":>14}{"RTF":>12}{"x real time":>14}']
+    for stage, result in results['stages'].items():
+        rtf = result.get('rtf')
+        lines.append(f'{stage:<22}{result["items"]:>10}{result["elapsed"]:>12.3f}{result["items_per_sec"]:>14.1f}'
+                     f'{f"{rtf:.4f}" if rtf else "-":>12}{f"{1 / rtf:.1f}" if rtf else "-":>14}')
+
+    return '\n'.join(lines)
+
+
+def main():
+    # noinspection PyTypeChecker
+    parser = argparse.ArgumentParser(
+        description='''
+Benchmark the decoding, spectrum, dataset and inference stages of micmon on synthetic labelled audio.''',
+
+        epilog=f'''
+The audio is generated locally with the ffmpeg lavfi sources: pink noise with a 1 kHz tone that is switched
+on and off every --label-period seconds. For each stage the tool reports the number of processed items,
+the elapsed time, the throughput and, for the stages that process audio, the real-time factor (processing
+time divided by the duration of the audio). Available stages: {", ".join(stages)}.
+''', formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--duration', help=f'Duration in seconds of the synthetic audio '
+                                           f'(default: {defaults["duration"]})',
+                        required=False, default=defaults['duration'], dest='duration', type=float)
+    parser.add_argument('-d', '--sample-duration', help=f'Duration in seconds of each audio segment '
+                                                        f'(default: {defaults["sample_duration"]})',
+                        required=False, default=defaults['sample_duration'], dest='sample_duration', type=float)
+    parser.add_argument('-r', '--sample-rate', help=f'Audio sample rate (default: {defaults["sample_rate"]} Hz)',
+                        required=False, default=defaults['sample_rate'], dest='sample_rate', type=int)
+    parser.add_argument('-c', '--channels', help=f'Number of decoded audio channels '
+                                                 f'(default: {defaults["channels"]})',
+                        required=False, default=defaults['channels'], dest='channels', type=int)
+    parser.add_argument('--low', help=f'Lowest frequency of the spectrum (default: {defaults["low_freq"]} Hz)',
+                        required=False, default=defaults['low_freq'], dest='low_freq', type=int)
+    parser.add_argument('--high', help=f'Highest frequency of the spectrum (default: {defaults["high_freq"]} Hz)',
+                        required=False, default=defaults['high_freq'], dest='high_freq', type=int)
+    parser.add_argument('-b', '--bins', help=f'Number of frequency bins (default: {defaults["bins"]})',
+                        required=False, default=defaults['bins'], dest='bins', type=int)
+    parser.add_argument('--label-period', help=f'Seconds between two label changes in the synthetic audio '
+                                               f'(default: {defaults["label_period"]})',
+                        required=False, default=defaults['label_period'], dest='label_period', type=int)
+    parser.add_argument('--rows', help=f'Number of rows of the synthetic dataset used by the dataset stages '
+                                       f'(default: {defaults["rows"]})',
+                        required=False, default=defaults['rows'], dest='rows', type=int)
+    parser.add_argument('--batch-size', help=f'Batch size used by the predict stages '
+                                             f'(default: {defaults["batch_size"]})',
+                        required=False, default=defaults['batch_size'], dest='batch_size', type=int)
+    parser.add_argument('--ffmpeg', help=f'Absolute path to the ffmpeg executable (default: {defaults["ffmpeg_bin"]})',
+                        required=False, default=defaults['ffmpeg_bin'], dest='ffmpeg_bin', type=str)
+    parser.add_argument('-s', '--stages', help='Comma-separated list of the stages to run (default: all)',
+                        required=False, default=','.join(stages), dest='stages', type=str)
+    parser.add_argument('-w', '--work-dir', help='Directory where the audio and datasets are generated '
+                                                 '(default: a temporary directory)',
+                        required=False, default=None, dest='work_dir', type=str)
+    parser.add_argument('--json', help='Print the results as JSON, so that runs can be stored and compared',
+                        required=False, default=False, dest='json', action='store_true')
+
+    opts, args = parser.parse_known_args(sys.argv[1:])
+    if opts.json:
+        # The log is written to stdout, so keep it quiet to produce valid JSON
+        logger.setLevel(logging.ERROR)
+
+    bench_args = dict(duration=opts.duration, sample_duration=opts.sample_duration, sample_rate=opts.sample_rate,
+                      channels=opts.channels, low_freq=opts.low_freq, high_freq=opts.high_freq, bins=opts.bins,
+                      label_period=opts.label_period, rows=opts.rows, batch_size=opts.batch_size,
+                      ffmpeg_bin=os.path.expanduser(opts.ffmpeg_bin),
+                      selected=[stage.strip() for stage in opts.stages.split(',') if stage.strip()])
+
+    if opts.work_dir:
+        results = run_benchmarks(os.path.abspath(os.path.expanduser(opts.work_dir)), **bench_args)
+    else:
+        with tempfile.TemporaryDirectory(prefix='micmon-bench-') as work_dir:
+            results = run_benchmarks(work_dir, **bench_args)
+
+    print(json.dumps(results, indent=2) if opts.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
 import argparse
+import hashlib
+import json
 import logging
 import os
+import pathlib
+import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import Callable, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 from micmon.audio import AudioDirectory, AudioFile, AudioSegment
-from micmon.dataset import DatasetWriter
+from micmon.audio.spectrum import min_sample_rate
+from micmon.dataset import DatasetWriter, StreamingDatasetWriter
+from micmon.dataset.quantize import sample_dtypes
 
 logger = logging.getLogger(__name__)
 defaults = {
@@ -12,31 +24,292 @@ defaults = {
     'sample_rate': 44100,
     'channels': 1,
     'ffmpeg_bin': 'ffmpeg',
+    'jobs': 1,
+    'shards': 1,
+    'dtype': 'float32',
 }
 
+frames_per_block = 256
+# Number of frames transformed together when the same FFT is shared by several feature configurations
+frames_per_batch = 64
+
+# Keeps track of the inputs and parameters used to generate each dataset file in the output directory
+manifest_file_name = '.manifest.json'
+
+
+def process_audio_dir(audio_dir: AudioDirectory, dataset_file: str,
+                      low_freq: int = AudioSegment.default_low_freq,
+                      high_freq: int = AudioSegment.default_high_freq,
+                      bins: int = AudioSegment.default_bins,
+                      sample_duration: float = defaults['sample_duration'],
+                      sample_rate: int = defaults['sample_rate'],
+                      channels: int = defaults['channels'],
+                      ffmpeg_bin: str = defaults['ffmpeg_bin'],
+                      streaming: bool = False,
+                      shards: int = defaults['shards'],
+                      dtype: str = defaults['dtype']) -> Tuple[int, float, float]:
+    # Returns the number of processed segments, their total duration and the processing time
+    start = time.monotonic()
+    n_samples = 0
+    audio_duration = 0.
+    writer_class = StreamingDatasetWriter if streaming else DatasetWriter
+
+    with AudioFile(audio_dir.audio_file, audio_dir.labels_file,
+                   sample_duration=sample_duration, sample_rate=sample_rate, channels=channels,
+                   ffmpeg_bin=os.path.expanduser(ffmpeg_bin), shards=shards,
+                   ffprobe_bin=os.path.join(os.path.dirname(os.path.expanduser(ffmpeg_bin)), 'ffprobe')
+                   if os.path.dirname(ffmpeg_bin) else 'ffprobe') as reader, \
+            writer_class(dataset_file, low_freq=low_freq, high_freq=high_freq, bins=bins, dtype=dtype,
+                         sample_duration=sample_duration, sample_rate=sample_rate) as writer:
+        # The audio is decoded and labelled in blocks of frames, so memory usage doesn't depend on its length
+        while True:
+            frames = reader.read_frames(max_frames=frames_per_block)
+            if not len(frames.audio):
+                break
+
+            writer.add_frames(frames.audio, frames.labels, sample_rate=sample_rate, channels=channels)
+            n_labelled = int(np.count_nonzero(frames.labels >= 0))
+            n_samples += n_labelled
+            audio_duration += n_labelled * frames.audio.shape[1] / (sample_rate * channels)
+
+    return n_samples, audio_duration, time.monotonic() - start
+
+
+def process_audio_dir_multi(audio_dir: AudioDirectory, targets: Sequence[Tuple[str, dict]],
+                            sample_rate: int = defaults['sample_rate'],
+                            channels: int = defaults['channels'],
+                            ffmpeg_bin: str = defaults['ffmpeg_bin'],
+                            streaming: bool = False,
+                            shards: int = defaults['shards'],
+                            dtype: str = defaults['dtype']) -> Tuple[int, float, float]:
+    # Writes one dataset for each (dataset_file, features) target, where features contains low_freq, high_freq,
+    # bins and sample_duration. The audio is decoded once, and the FFT of each frame is calculated once for
+    # each sample duration and binned for all the targets that share it.
+    # Returns the number of processed segments, the duration of the decoded audio and the processing time.
+    start = time.monotonic()
+    n_samples = 0
+    audio_duration = 0.
+    writer_class = StreamingDatasetWriter if streaming else DatasetWriter
+    durations = sorted(set(features['sample_duration'] for _, features in targets))
+
+    with AudioFile(audio_dir.audio_file, audio_dir.labels_file,
+                   sample_duration=durations[0], sample_rate=sample_rate, channels=channels,
+                   ffmpeg_bin=os.path.expanduser(ffmpeg_bin), shards=shards,
+                   ffprobe_bin=os.path.join(os.path.dirname(os.path.expanduser(ffmpeg_bin)), 'ffprobe')
+                   if os.path.dirname(ffmpeg_bin) else 'ffprobe') as reader, ExitStack() as stack:
+        writers = {duration: [] for duration in durations}
+        for dataset_file, features in targets:
+            writers[features['sample_duration']].append(stack.enter_context(writer_class(
+                dataset_file, low_freq=features['low_freq'], high_freq=features['high_freq'],
+                bins=features['bins'], dtype=dtype, sample_duration=features['sample_duration'],
+                sample_rate=sample_rate)))
+
+        while True:
+            block = reader.read_multi_frames(durations, block_duration=frames_per_block * durations[-1])
+            if not any(len(frames.audio) for frames in block.values()):
+                break
+
+            for duration, frames in block.items():
+                keep = np.flatnonzero(frames.labels >= 0)
+                binnings = [(writer.low_freq, writer.high_freq, writer.bins) for writer in writers[duration]]
+                for i in range(0, len(keep), frames_per_batch):
+                    idx = keep[i:i + frames_per_batch]
+                    spectra = AudioSegment.batch_spectra(frames.audio[idx], binnings, sample_rate=sample_rate,
+                                                         channels=channels)
+                    for writer, samples in zip(writers[duration], spectra):
+                        writer.add_spectra(samples, frames.labels[idx])
+
+                n_samples += len(keep) * len(writers[duration])
+
+            audio_duration += max(len(frames.audio) * duration for duration, frames in block.items())
+
+    return n_samples, audio_duration, time.monotonic() - start
+
+
+def dataset_signature(audio_dir: AudioDirectory, **opts) -> dict:
+    # The audio files can be large, so they are tracked by size and modification time rather than content
+    audio_stat = os.stat(audio_dir.audio_file)
+    with open(audio_dir.labels_file, 'rb') as f:
+        labels_hash = hashlib.sha1(f.read()).hexdigest()
+
+    return {
+        'audio_file': audio_dir.audio_file,
+        'audio_size': audio_stat.st_size,
+        'audio_mtime': audio_stat.st_mtime_ns,
+        'labels_file': audio_dir.labels_file,
+        'labels_hash': labels_hash,
+        **opts,
+    }
+
+
+def load_manifest(dataset_dir: str) -> dict:
+    manifest_file = os.path.join(dataset_dir, manifest_file_name)
+    if not os.path.isfile(manifest_file):
+        return {}
+
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(dataset_dir: str, manifest: dict):
+    manifest_file = os.path.join(dataset_dir, manifest_file_name)
+    pathlib.Path(dataset_dir).mkdir(parents=True, exist_ok=True)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def config_name(features: dict) -> str:
+    # Name of the output directory of a feature configuration, e.g. 250-7500Hz_100bins_2.0s
+    return f'{features["low_freq"]}-{features["high_freq"]}Hz_{features["bins"]}bins_' \
+           f'{float(features["sample_duration"])}s'
+
+
+def parse_config(value: str, sample_duration: float = defaults['sample_duration']) -> dict:
+    # low_freq:high_freq:bins[:sample_duration]
+    fields = value.split(':')
+    if len(fields) not in (3, 4):
+        raise ValueError(f'Invalid feature configuration: {value}')
+
+    return dict(low_freq=int(fields[0]), high_freq=int(fields[1]), bins=int(fields[2]),
+                sample_duration=float(fields[3]) if len(fields) > 3 else sample_duration)
+
 
 def create_dataset(audio_dir: str, dataset_dir: str,
                    low_freq: int = AudioSegment.default_low_freq,
                    high_freq: int = AudioSegment.default_high_freq,
                    bins: int = AudioSegment.default_bins,
                    sample_duration: float = defaults['sample_duration'],
-                   sample_rate: int = defaults['sample_rate'],
+                   sample_rate: Union[int, str] = defaults['sample_rate'],
                    channels: int = defaults['channels'],
-                   ffmpeg_bin: str = defaults['ffmpeg_bin']):
+                   ffmpeg_bin: str = defaults['ffmpeg_bin'],
+                   jobs: int = defaults['jobs'],
+                   incremental: bool = False,
+                   streaming: bool = False,
+                   shards: int = defaults['shards'],
+                   dtype: str = defaults['dtype'],
+                   configs: Optional[Sequence[dict]] = None):
+    # If configs is set, each configuration (a dict with low_freq, high_freq, bins and sample_duration) gets
+    # its own sub-directory of dataset_dir, and all of them are generated in a single pass over the audio.
+    # Otherwise the datasets are generated in dataset_dir with the low_freq, high_freq, bins and
+    # sample_duration arguments.
     audio_dir = os.path.abspath(os.path.expanduser(audio_dir))
     dataset_dir = os.path.abspath(os.path.expanduser(dataset_dir))
     audio_dirs = AudioDirectory.scan(audio_dir)
+    outputs = {
+        os.path.join(dataset_dir, config_name(config)): config
+        for config in configs
+    } if configs else {
+        dataset_dir: dict(low_freq=low_freq, high_freq=high_freq, bins=bins, sample_duration=sample_duration)
+    }
+
+    if sample_rate == 'auto':
+        # Decode at the lowest standard rate that covers the frequency range. ffmpeg low-pass filters the
+        # audio when it resamples it, so the frequencies above the new Nyquist limit don't alias into the range
+        sample_rate = min_sample_rate(max(config['high_freq'] for config in outputs.values()))
+        logger.info(f'Decoding the audio at {sample_rate} Hz')
+
+    sample_rate = int(sample_rate)
+    audio_opts = dict(sample_rate=sample_rate, channels=channels, dtype=dtype)
+    opts = dict(**audio_opts, ffmpeg_bin=ffmpeg_bin, streaming=streaming, shards=shards)
+
+    def dataset_file(output_dir: str, audio_dir_: AudioDirectory) -> str:
+        # Streaming datasets are stored in a directory named like the audio sample
+        return os.path.join(output_dir, os.path.basename(audio_dir_.path) + ('' if streaming else '.npz'))
+
+    manifests = {output_dir: load_manifest(output_dir) for output_dir in outputs}
+    signatures = {
+        output_dir: {
+            os.path.basename(dataset_file(output_dir, audio_dir_)): dataset_signature(audio_dir_, **config,
+                                                                                      **audio_opts)
+            for audio_dir_ in audio_dirs
+        }
+        for output_dir, config in outputs.items()
+    }
+
+    def is_outdated(output_dir: str, audio_dir_: AudioDirectory) -> bool:
+        name = os.path.basename(dataset_file(output_dir, audio_dir_))
+        return not os.path.exists(os.path.join(output_dir, name)) or \
+            manifests[output_dir].get(name) != signatures[output_dir][name]
+
+    # Output directories to be generated for each audio sample
+    tasks = [(audio_dir_, list(outputs.keys())) for audio_dir_ in audio_dirs]
+
+    if incremental:
+        for output_dir, manifest in manifests.items():
+            # Remove the datasets whose audio samples no longer exist
+            for name in set(manifest.keys()).difference(signatures[output_dir].keys()):
+                logger.info(f'Removing stale dataset {os.path.join(output_dir, name)}')
+                if os.path.isdir(os.path.join(output_dir, name)):
+                    shutil.rmtree(os.path.join(output_dir, name))
+                elif os.path.isfile(os.path.join(output_dir, name)):
+                    os.remove(os.path.join(output_dir, name))
+                del manifest[name]
+
+            save_manifest(output_dir, manifest)
+
+        n_datasets = len(audio_dirs) * len(outputs)
+        tasks = [
+            (audio_dir_, [output_dir for output_dir in output_dirs if is_outdated(output_dir, audio_dir_)])
+            for audio_dir_, output_dirs in tasks
+        ]
+        tasks = [(audio_dir_, output_dirs) for audio_dir_, output_dirs in tasks if output_dirs]
+        logger.info(f'{n_datasets - sum(len(output_dirs) for _, output_dirs in tasks)} of {n_datasets} '
+                    f'datasets are up to date')
+
+    def job(audio_dir_: AudioDirectory, output_dirs: Sequence[str]) -> Tuple[Callable, tuple, dict]:
+        if len(output_dirs) == 1:
+            return process_audio_dir, (audio_dir_, dataset_file(output_dirs[0], audio_dir_)), \
+                dict(**outputs[output_dirs[0]], **opts)
 
-    for audio_dir in audio_dirs:
-        dataset_file = os.path.join(dataset_dir, os.path.basename(audio_dir.path) + '.npz')
-        logger.info(f'Processing audio sample {audio_dir.path}')
+        targets = [(dataset_file(output_dir, audio_dir_), outputs[output_dir]) for output_dir in output_dirs]
+        return process_audio_dir_multi, (audio_dir_, targets), opts
 
-        with AudioFile(audio_dir.audio_file, audio_dir.labels_file,
-                       sample_duration=sample_duration, sample_rate=sample_rate, channels=channels,
-                       ffmpeg_bin=os.path.expanduser(ffmpeg_bin)) as reader, \
-                DatasetWriter(dataset_file, low_freq=low_freq, high_freq=high_freq, bins=bins) as writer:
-            for sample in reader:
-                writer += sample
+    def done(audio_dir_: AudioDirectory, output_dirs: Sequence[str]):
+        for output_dir in output_dirs:
+            name = os.path.basename(dataset_file(output_dir, audio_dir_))
+            manifests[output_dir][name] = signatures[output_dir][name]
+            save_manifest(output_dir, manifests[output_dir])
+
+    def progress(i: int, audio_dir_: AudioDirectory, n_samples: int, audio_duration: float, elapsed: float):
+        elapsed = max(elapsed, 1e-6)
+        logger.info(f'[{i}/{len(tasks)}] Processed audio sample {audio_dir_.path}: {n_samples} segments in '
+                    f'{elapsed:.1f} s ({n_samples / elapsed:.1f} segments/s, '
+                    f'{audio_duration / elapsed:.1f}x real time)')
+
+    # The writers save whatever was processed when they are interrupted, so the datasets to be (re)generated
+    # are removed from the manifests first: they are only marked as up to date once they are complete
+    for output_dir, manifest in manifests.items():
+        names = [os.path.basename(dataset_file(output_dir, audio_dir_))
+                 for audio_dir_, output_dirs in tasks if output_dir in output_dirs]
+        if any(name in manifest for name in names):
+            for name in names:
+                manifest.pop(name, None)
+
+            save_manifest(output_dir, manifest)
+
+    start = time.monotonic()
+    if jobs <= 1:
+        for i, (audio_dir, output_dirs) in enumerate(tasks):
+            logger.info(f'Processing audio sample {audio_dir.path}')
+            fn, args, kwargs = job(audio_dir, output_dirs)
+            progress(i + 1, audio_dir, *fn(*args, **kwargs))
+            done(audio_dir, output_dirs)
+    else:
+        # Each worker processes one audio sample at a time with `shards` ffmpeg decoders, so at most
+        # jobs * shards decoders run at once
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for audio_dir, output_dirs in tasks:
+                fn, args, kwargs = job(audio_dir, output_dirs)
+                futures[executor.submit(fn, *args, **kwargs)] = (audio_dir, output_dirs)
+
+            for i, future in enumerate(as_completed(futures)):
+                progress(i + 1, futures[future][0], *future.result())
+                done(*futures[future])
+
+    logger.info(f'Processed {len(tasks)} audio samples in {time.monotonic() - start:.1f} s')
 
 
 def main():
@@ -97,8 +370,11 @@ Tool to create numpy dataset files with audio spectrum data from a set of labell
                                                         f'{defaults["sample_duration"]}).',
                         required=False, default=defaults['sample_duration'], dest='sample_duration', type=float)
 
-    parser.add_argument('-r', '--sample-rate', help=f'Audio sample rate (default: {defaults["sample_rate"]} Hz)',
-                        required=False, default=defaults['sample_rate'], dest='sample_rate', type=int)
+    parser.add_argument('-r', '--sample-rate', help=f'Audio sample rate, or "auto" to decode the audio at the '
+                                                    f'lowest standard rate that covers the --high frequency '
+                                                    f'(default: {defaults["sample_rate"]} Hz)',
+                        required=False, default=defaults['sample_rate'], dest='sample_rate',
+                        type=lambda value: value if value == 'auto' else int(value))
 
     parser.add_argument('-c', '--channels', help=f'Number of destination audio channels (default: '
                                                  f'{defaults["channels"]})',
@@ -107,10 +383,56 @@ Tool to create numpy dataset files with audio spectrum data from a set of labell
     parser.add_argument('--ffmpeg', help=f'Absolute path to the ffmpeg executable (default: {defaults["ffmpeg_bin"]})',
                         required=False, default=defaults['ffmpeg_bin'], dest='ffmpeg_bin', type=str)
 
+    parser.add_argument('-j', '--jobs', help=f'Number of audio samples to process in parallel. Each job runs its '
+                                             f'own ffmpeg decoder, or --shards decoders, so up to jobs * shards '
+                                             f'decoders run at once (default: {defaults["jobs"]})',
+                        required=False, default=defaults['jobs'], dest='jobs', type=int)
+
+    parser.add_argument('--dtype', help=f'Storage format of the spectra: float32, float16, or uint8 with a '
+                                        f'per-file scale and offset. The compact formats also store the classes '
+                                        f'with the smallest integer type (default: {defaults["dtype"]})',
+                        required=False, default=defaults['dtype'], dest='dtype', choices=sample_dtypes)
+
+    parser.add_argument('--shards', help=f'Split each audio file into this many time ranges that are decoded in '
+                                         f'parallel by separate ffmpeg processes. Useful for few long recordings. '
+                                         f'The ffprobe executable next to ffmpeg is used to get the duration of the '
+                                         f'files (default: {defaults["shards"]})',
+                        required=False, default=defaults['shards'], dest='shards', type=int)
+
+    parser.add_argument('-i', '--incremental', help='Only generate the datasets whose audio samples, labels or '
+                                                    'parameters have changed since the previous run, and remove '
+                                                    'the datasets whose audio samples have been deleted',
+                        required=False, default=False, dest='incremental', action='store_true')
+
+    parser.add_argument('-s', '--streaming', help='Write each dataset to a directory of uncompressed .npy files, '
+                                                  'flushed to disk in blocks while the audio is processed, instead '
+                                                  'of a compressed .npz file. Memory usage no longer depends on '
+                                                  'the length of the audio samples',
+                        required=False, default=False, dest='streaming', action='store_true')
+
+    parser.add_argument('--config', help='Feature configuration in the format LOW:HIGH:BINS[:SAMPLE_DURATION]. It '
+                                         'can be repeated to generate the datasets for several configurations in a '
+                                         'single pass: each audio file is decoded once, the spectrum of each segment '
+                                         'is calculated once for each sample duration, and the datasets of each '
+                                         'configuration are saved to a sub-directory of dataset_dir named like '
+                                         '250-7500Hz_100bins_2.0s. --low, --high and --bins are ignored, and '
+                                         '--sample-duration is used when a configuration has no duration',
+                        required=False, default=None, dest='configs', action='append')
+
     opts, args = parser.parse_known_args(sys.argv[1:])
+    try:
+        configs = [parse_config(config, sample_duration=opts.sample_duration)
+                   for config in opts.configs] if opts.configs else None
+    except ValueError as e:
+        parser.error(str(e))
+        return
+
     return create_dataset(audio_dir=opts.audio_dir, dataset_dir=opts.dataset_dir, low_freq=opts.low_freq,
                           high_freq=opts.high_freq, bins=opts.bins, sample_duration=opts.sample_duration,
-                          sample_rate=opts.sample_rate, channels=opts.channels, ffmpeg_bin=opts.ffmpeg_bin)
+                          sample_rate=opts.sample_rate, channels=opts.channels, ffmpeg_bin=opts.ffmpeg_bin,
+                          jobs=opts.jobs, incremental=opts.incremental, streaming=opts.streaming,
+                          shards=opts.shards, dtype=opts.dtype,
+                          configs=configs)
 
 
 if __name__ == '__main__':
@@ -20,7 +20,10 @@ setup(
     author_email="info@fabiomanganiello.com",
     description="Programmable Tensorflow-based sound/noise detector",
     license="MIT",
-    python_requires='>= 3.6',
+    python_requires='>= 3.7',
+    install_requires=[
+        'numpy>=1.20',
+    ],
     keywords="machine-learning tensorflow sound-detection",
     url="https://github.com/BlackLight/micmon",
     packages=find_packages(),
@@ -30,6 +33,7 @@ setup(
     entry_points={
         'console_scripts': [
             'micmon-datagen=micmon.utils.datagen:main',
+            'micmon-bench=micmon.utils.bench:main',
         ],
     },
     classifiers=[
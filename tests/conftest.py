@@ -0,0 +1,37 @@
+import stat
+import sys
+
+import pytest
+
+# Fake ffmpeg: the input file contains the duration of the audio, and the decoded sample i is equal to
+# i % 30000. If the input file also contains "short", the decoders that seek into the file stop halfway.
+fake_ffmpeg = f'''#!{sys.executable}
+import sys
+args = sys.argv[1:]
+opt = lambda name, default=None: args[args.index(name) + 1] if name in args else default
+src = open(opt('-i')).read().split()
+rate = int(opt('-ar'))
+start = int(round(float(opt('-ss', 0)) * rate))
+end = int(round(float(src[0]) * rate))
+if '-t' in args:
+    end = min(end, start + int(round(float(opt('-t')) * rate)))
+if start and 'short' in src:
+    end = start + (end - start) // 2
+for i in range(start, end, 4096):
+    sys.stdout.buffer.write((__import__('numpy').arange(i, min(end, i + 4096)) % 30000).astype('<i2').tobytes())
+'''
+
+fake_ffprobe = f'''#!{sys.executable}
+import sys
+print(open(sys.argv[-1]).read().split()[0])
+'''
+
+
+@pytest.fixture
+def ffmpeg_dir(tmp_path):
+    for name, script in (('ffmpeg', fake_ffmpeg), ('ffprobe', fake_ffprobe)):
+        path = tmp_path / name
+        path.write_text(script)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    return tmp_path
@@ -0,0 +1,17 @@
+import pytest
+
+from micmon.audio import AsyncAudioDevice, AsyncAudioFile
+
+
+@pytest.mark.parametrize('kwargs', [dict(buffered=True, overflow='block'), dict(pool_size=4)])
+def test_async_sources_reject_unsupported_options(tmp_path, kwargs):
+    with pytest.raises(ValueError):
+        AsyncAudioDevice('alsa', device='plughw:1,0', **kwargs)
+    with pytest.raises(ValueError):
+        AsyncAudioFile(str(tmp_path / 'audio.mp3'), **kwargs)
+
+
+def test_async_file_rejects_shards(tmp_path):
+    with pytest.raises(ValueError):
+        AsyncAudioFile(str(tmp_path / 'audio.mp3'), shards=2)
+    AsyncAudioFile(str(tmp_path / 'audio.mp3'), hop_duration=1.)
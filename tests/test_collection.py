@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+
+from micmon.dataset import Dataset, DatasetCollection, DatasetWriter, StreamingDatasetWriter
+from micmon.dataset.collection import DatasetFile
+
+
+def write_datasets(path, n_files: int, rows: int = 20, bins: int = 10):
+    rng = np.random.default_rng(0)
+    for i in range(n_files):
+        frames = rng.integers(-3000, 3000, (rows, 1000), dtype=np.int16)
+        with DatasetWriter(str(path / f'{i}.npz'), low_freq=20, high_freq=400, bins=bins) as writer:
+            writer.add_frames(frames, np.arange(rows) % 2, sample_rate=1000, channels=1)
+
+
+def test_npz_samples_cache_is_bounded(tmp_path):
+    write_datasets(tmp_path, n_files=6)
+    collection = DatasetCollection.scan(str(tmp_path), cache_size=2)
+    assert collection.bins == 10
+    assert not collection.cache._items
+
+    rows = [collection[slice(i, i + 10)][0] for i in range(0, len(collection), 10)]
+    assert len(collection.cache._items) == 2
+    assert np.array_equal(np.concatenate(rows), collection[:][0])
+
+
+def test_bins_without_metadata(tmp_path):
+    np.savez(str(tmp_path / 'legacy.npz'), samples=np.ones((5, 7), dtype=np.float32), classes=np.zeros(5),
+             cutoff_frequencies=np.array([20, 400]))
+    dataset_file = DatasetFile(str(tmp_path / 'legacy.npz'))
+    assert dataset_file.bins == 7
+    assert dataset_file.read(slice(0, 2)).shape == (2, 7)
+
+
+def test_interrupted_compaction_is_detected(tmp_path, monkeypatch):
+    frames = np.random.default_rng(0).integers(-3000, 3000, (20, 1000), dtype=np.int16)
+    replace = os.replace
+
+    def interrupted_replace(src, dst):
+        # Dies between the swap of the compact samples and the swap of their metadata
+        if dst.endswith(StreamingDatasetWriter.metadata_file_name) and \
+                os.path.isfile(dst) and not os.path.isfile(str(tmp_path / 'data' / 'samples.npy.tmp')):
+            raise KeyboardInterrupt
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', interrupted_replace)
+    with pytest.raises(KeyboardInterrupt):
+        with StreamingDatasetWriter(str(tmp_path / 'data'), low_freq=20, high_freq=400, bins=10,
+                                    dtype='uint8') as writer:
+            writer.add_frames(frames, np.arange(20) % 2, sample_rate=1000, channels=1)
+
+    with pytest.raises(ValueError):
+        DatasetFile(str(tmp_path / 'data'))
+    with pytest.raises(ValueError):
+        Dataset.load(str(tmp_path / 'data'))
+
+
+def test_dataset_samples_setters(tmp_path):
+    write_datasets(tmp_path, n_files=1)
+    dataset = Dataset.load(str(tmp_path / '0.npz'), validation_split=0.5)
+    dataset.train_samples = dataset.train_samples * 2
+    dataset.validation_samples = np.zeros_like(dataset.validation_samples)
+    assert not dataset.validation_samples.any()
+    dataset.shuffle()
+    assert dataset.validation_samples.any()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='Needs /proc to count the open files')
+def test_dataset_dirs_file_descriptors_are_bounded(tmp_path):
+    frames = np.random.default_rng(0).integers(-3000, 3000, (4, 1000), dtype=np.int16)
+    for i in range(20):
+        with StreamingDatasetWriter(str(tmp_path / str(i)), low_freq=20, high_freq=400, bins=10) as writer:
+            writer.add_frames(frames, np.arange(4) % 2, sample_rate=1000, channels=1)
+
+    open_fds = len(os.listdir('/proc/self/fd'))
+    collection = DatasetCollection.scan(str(tmp_path), cache_size=2)
+    samples, classes = collection[:]
+    assert samples.shape == (80, 10) and len(classes) == 80
+    assert len(os.listdir('/proc/self/fd')) <= open_fds + 2
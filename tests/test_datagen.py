@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from micmon.utils import datagen
+
+
+def test_interrupted_run_is_regenerated(ffmpeg_dir, tmp_path, monkeypatch):
+    for name in ('a', 'b', 'c'):
+        (tmp_path / 'audio' / name).mkdir(parents=True)
+        (tmp_path / 'audio' / name / 'audio.mp3').write_text('15')
+        (tmp_path / 'audio' / name / 'labels.json').write_text('{"00:00": "negative", "00:05": "positive"}')
+
+    args = dict(audio_dir=str(tmp_path / 'audio'), dataset_dir=str(tmp_path / 'datasets'), low_freq=20,
+                high_freq=400, bins=10, sample_duration=0.5, sample_rate=1000, ffmpeg_bin=str(ffmpeg_dir / 'ffmpeg'))
+    datagen.create_dataset(**args)
+
+    process_audio_dir = datagen.process_audio_dir
+    processed = []
+    interrupt = [True]
+
+    def process(audio_dir, *args_, **kwargs):
+        if interrupt[0] and audio_dir.path.endswith('b'):
+            raise KeyboardInterrupt
+
+        processed.append(audio_dir.path)
+        return process_audio_dir(audio_dir, *args_, **kwargs)
+
+    # A full run that is interrupted while b is processed, then an incremental run
+    monkeypatch.setattr(datagen, 'process_audio_dir', process)
+    with pytest.raises(KeyboardInterrupt):
+        datagen.create_dataset(**args)
+
+    interrupt[0] = False
+    processed.clear()
+    datagen.create_dataset(**args, incremental=True)
+    assert any(path.endswith('b') for path in processed)
+    with np.load(str(tmp_path / 'datasets' / 'b.npz')) as data:
+        assert data['samples'].shape == (30, 10)
@@ -0,0 +1,30 @@
+import numpy as np
+
+from micmon.audio import AudioSegment, EnergyGate
+
+sample_rate = 100
+
+
+def segment(level: int, timestamp=None, duration: float = 2.) -> AudioSegment:
+    return AudioSegment(np.full(int(duration * sample_rate), level, dtype=np.int16), sample_rate=sample_rate,
+                        timestamp=timestamp)
+
+
+def test_hold_time_with_contiguous_segments():
+    gate = EnergyGate(threshold_db=-40, hold_time=4)
+    decisions = [gate.update(segment(level, timestamp=2. * i)) for i, level in enumerate([10000, 0, 0, 0])]
+    # The gate closes on the segment that completes hold_time seconds of silence
+    assert decisions == [True, True, False, False]
+
+
+def test_hold_time_with_overlapping_windows():
+    # 2 second windows every 0.25 seconds: the silence is measured in hops, not in window durations
+    gate = EnergyGate(threshold_db=-40, hold_time=2)
+    assert gate.update(segment(10000, timestamp=0.))
+    decisions = [gate.update(segment(0, timestamp=0.25 * (i + 1))) for i in range(10)]
+    assert decisions == [True] * 7 + [False] * 3
+
+
+def test_hold_time_without_timestamps():
+    gate = EnergyGate(threshold_db=-40, hold_time=2)
+    assert [gate.update(segment(level)) for level in [10000, 0, 0]] == [True, False, False]
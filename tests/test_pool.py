@@ -0,0 +1,130 @@
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from micmon.audio import AudioSegment, AudioSource
+from micmon.metrics import metrics
+from micmon.model.base import BaseModel, batch_stream
+from micmon.model.monitor import Monitor
+
+sample_rate = 100
+chunk_samples = 10
+n_chunks = 40
+
+# Fake decoder: writes n_chunks chunks of int16 audio, where all the samples of chunk i are equal to i
+decoder = f'''
+import sys, time
+for i in range({n_chunks}):
+    sys.stdout.buffer.write(i.to_bytes(2, 'little', signed=True) * {chunk_samples})
+    sys.stdout.buffer.flush()
+    time.sleep(0.002)
+'''
+
+
+class FakeSource(AudioSource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, sample_duration=chunk_samples / sample_rate, sample_rate=sample_rate, **kwargs)
+        self.ffmpeg_args = (sys.executable, '-c', decoder)
+
+
+class RecordingModel(BaseModel):
+    # Records the audio of the segments at the time they are scored
+    def __init__(self):
+        self.values = []
+
+    def _forward(self, spectra: np.ndarray) -> np.ndarray:
+        return np.ones((len(spectra), 1))
+
+    def predict_many(self, segments, gate=None, gated=None):
+        self.values.extend(np.unique(segment.audio).tolist() for segment in segments)
+        return [(0, 1.)] * len(segments)
+
+
+def test_pool_rejects_drop_oldest():
+    with pytest.raises(ValueError):
+        FakeSource(buffered=True, buffer_size=4, pool_size=2)
+
+
+def test_pool_with_blocking_buffer():
+    with FakeSource(buffered=True, buffer_size=4, overflow='block', pool_size=2) as source:
+        for i, segment in enumerate(source):
+            value = segment.audio[0]
+            time.sleep(0.01)
+            assert (segment.audio == value).all()
+            assert value == i
+
+
+def test_batch_stream_copies_pooled_segments():
+    with FakeSource(pool_size=2) as source:
+        batches = list(batch_stream(source, batch_size=8))
+
+    values = [int(segment.audio[0]) for batch, _ in batches for segment in batch]
+    assert values == list(range(n_chunks))
+    assert all((segment.audio == segment.audio[0]).all() for batch, _ in batches for segment in batch)
+
+
+def test_monitor_copies_pooled_segments():
+    model = RecordingModel()
+    with Monitor(model, [FakeSource(pool_size=2)], batch_size=8, flush_timeout=None) as monitor:
+        for _ in monitor:
+            time.sleep(0.005)
+
+    assert model.values == [[i] for i in range(n_chunks)]
+
+
+def test_segment_copy():
+    segment = AudioSegment(np.arange(10, dtype=np.int16), sample_rate=sample_rate, label=1, timestamp=2.)
+    copy = segment.copy()
+    segment.audio[:] = 0
+    assert copy.audio.tolist() == list(range(10))
+    assert (copy.label, copy.timestamp, copy.sample_rate) == (1, 2., sample_rate)
+
+
+def test_buffer_gauges_per_source():
+    metrics.enable()
+    try:
+        for name in ('mic "1"', 'mic "2"'):
+            with FakeSource(buffered=True, overflow='block', name=name) as source:
+                next(iter(source))
+
+        snapshot = metrics.snapshot()
+        prometheus = metrics.prometheus()
+    finally:
+        metrics.disable()
+
+    sources = set(gauge['labels']['source'] for gauge in snapshot['gauges'] if gauge['name'] == 'queue_depth')
+    assert sources == {'mic "1"', 'mic "2"'}
+    assert 'source="mic \\"1\\""' in prometheus
+
+
+def test_monitor_closes_sources_when_enter_fails():
+    class FailingSource(FakeSource):
+        def __enter__(self):
+            raise IOError('No such device')
+
+    class TrackedSource(FakeSource):
+        process = None
+
+        def __exit__(self, *args):
+            self.process = self.ffmpeg
+            super().__exit__(*args)
+
+    source = TrackedSource()
+    with pytest.raises(IOError):
+        with Monitor(RecordingModel(), [source, FailingSource()]):
+            pass
+
+    assert source.process and source.process.poll() is not None
+
+
+def test_monitor_reader_exits_with_full_queue():
+    monitor = Monitor(RecordingModel(), [FakeSource()], queue_size=1)
+    monitor._queue.put(('0', None))
+    monitor._stop.set()
+    reader = threading.Thread(target=monitor._read, args=('0', []), daemon=True)
+    reader.start()
+    reader.join(timeout=2)
+    assert not reader.is_alive()
@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+
+from micmon.audio import AudioSegment
+from micmon.model import FanOut
+from micmon.model.base import BaseModel
+
+
+class ConstantModel(BaseModel):
+    sample_rate = 16000
+    bins = 10
+
+    def _forward(self, spectra: np.ndarray) -> np.ndarray:
+        return np.ones((len(spectra), 1))
+
+
+def segments(sample_rate: int, n: int = 3):
+    audio = np.random.default_rng(0).integers(-3000, 3000, 2 * sample_rate, dtype=np.int16)
+    return [AudioSegment(audio, sample_rate=sample_rate) for _ in range(n)]
+
+
+def test_rate_mismatch_warns_once(caplog):
+    model = ConstantModel()
+    with caplog.at_level(logging.WARNING):
+        model.predict_many(segments(16000))
+        assert not caplog.records
+
+        model.predict_many(segments(44100))
+        model.predict_many(segments(44100))
+        assert len(caplog.records) == 1
+        assert '44100 Hz' in caplog.text
+
+
+def test_fanout_rate_mismatch_warns(caplog):
+    fanout = FanOut([ConstantModel(), ConstantModel()])
+    with caplog.at_level(logging.WARNING):
+        fanout.predict_many(segments(44100))
+        fanout.predict_many(segments(44100))
+
+    assert len(caplog.records) == 2
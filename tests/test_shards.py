@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from micmon.audio import AudioFile
+from micmon.dataset import DatasetWriter
+
+
+def read_all(audio_file: str, ffmpeg_dir, **kwargs) -> np.ndarray:
+    with AudioFile(audio_file, sample_duration=0.5, sample_rate=1000, ffmpeg_bin=str(ffmpeg_dir / 'ffmpeg'),
+                   ffprobe_bin=str(ffmpeg_dir / 'ffprobe'), **kwargs) as reader:
+        return np.concatenate([segment.audio for segment in reader])
+
+
+def test_shards_match_single_decoder(ffmpeg_dir, tmp_path):
+    audio_file = tmp_path / 'audio.raw'
+    audio_file.write_text('10.2')
+    serial = read_all(str(audio_file), ffmpeg_dir)
+    # The trailing 0.2 seconds are shorter than a segment and are dropped
+    assert np.array_equal(serial, np.arange(10000) % 30000)
+    assert np.array_equal(read_all(str(audio_file), ffmpeg_dir, shards=3), serial)
+
+
+def test_shards_with_duration_past_the_end(ffmpeg_dir, tmp_path):
+    audio_file = tmp_path / 'audio.raw'
+    audio_file.write_text('10.2')
+    serial = read_all(str(audio_file), ffmpeg_dir, start=1, duration=20)
+    assert len(serial) == 9000
+    assert np.array_equal(read_all(str(audio_file), ffmpeg_dir, start=1, duration=20, shards=3), serial)
+
+
+def test_short_shard_raises(ffmpeg_dir, tmp_path):
+    audio_file = tmp_path / 'audio.raw'
+    audio_file.write_text('10.2 short')
+    with pytest.raises(IOError):
+        read_all(str(audio_file), ffmpeg_dir, shards=3)
+
+
+def test_shards_reject_buffered(tmp_path):
+    with pytest.raises(ValueError):
+        AudioFile(os.path.join(str(tmp_path), 'audio.raw'), shards=2, buffered=True)
+
+
+def test_short_tail_is_dropped(ffmpeg_dir, tmp_path):
+    # 0.2 seconds of audio don't have enough FFT coefficients for 100 bins between 20 and 400 Hz
+    audio_file = tmp_path / 'audio.raw'
+    audio_file.write_text('10.2')
+    (tmp_path / 'labels.json').write_text('{"00:00": "negative", "00:05": "positive"}')
+    with AudioFile(str(audio_file), sample_duration=0.5, sample_rate=1000, ffmpeg_bin=str(ffmpeg_dir / 'ffmpeg'),
+                   ffprobe_bin=str(ffmpeg_dir / 'ffprobe')) as reader, \
+            DatasetWriter(str(tmp_path / 'dataset.npz'), low_freq=20, high_freq=400, bins=100) as writer:
+        for segment in reader:
+            writer += segment
+
+    with np.load(str(tmp_path / 'dataset.npz')) as data:
+        assert data['samples'].shape == (20, 100)
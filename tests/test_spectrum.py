@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from micmon.audio import AudioSegment
+from micmon.audio.spectrum import bin_index
+from micmon.utils.datagen import parse_config
+
+
+def test_bin_index_rejects_too_many_bins():
+    assert len(bin_index(16000, 32000, 250, 7500, 100).counts) == 100
+    with pytest.raises(ValueError):
+        bin_index(16000, 320, 250, 300, 100)
+
+
+def test_parse_config():
+    assert parse_config('250:7500:100') == dict(low_freq=250, high_freq=7500, bins=100, sample_duration=2.0)
+    assert parse_config('250:7500:100:1.5')['sample_duration'] == 1.5
+    with pytest.raises(ValueError):
+        parse_config('250:7500')
+
+
+def test_raw_buffer_spectrum_requires_format():
+    audio = np.random.default_rng(0).integers(-3000, 3000, (4, 16000), dtype=np.int16)
+    with pytest.raises(ValueError):
+        AudioSegment.batch_spectrum(audio, low_freq=250, high_freq=7500, bins=10)
+
+    spectra = AudioSegment.batch_spectrum(audio, low_freq=250, high_freq=7500, bins=10, sample_rate=16000, channels=1)
+    segments = [AudioSegment(frame, sample_rate=16000) for frame in audio]
+    assert np.allclose(spectra, AudioSegment.batch_spectrum(segments, low_freq=250, high_freq=7500, bins=10))